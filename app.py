@@ -1,12 +1,28 @@
-from flask import Flask, request, abort
-from linebot.v3 import WebhookHandler
+from flask import Flask, Response, request, abort, jsonify
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
+from linebot.v3.messaging import (
+    Configuration, ApiClient, ApiException, MessagingApi, ReplyMessageRequest, PushMessageRequest,
+    ShowLoadingAnimationRequest, TextMessage
+)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 from dotenv import load_dotenv
 import os
 import json
+import logging
+import time
 import services.api_manager as api_manager
+import services.map_unit as map_unit
+import services.http_client as http_client
+import services.rule_parser as rule_parser
+import services.openai_receive_unit as openai_receive_unit
+import services.openai_send_unit as openai_send_unit
+import services.route_projection as route_projection
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+import services.hedging as hedging
+import services.metrics as metrics
+from services.webhook_queue import QueuedWebhookHandler
+from services.event_dedup import EventDeduplicator, WEBHOOK_DEDUP_ENABLED
 
 # Load environment variables
 load_dotenv()
@@ -14,12 +30,48 @@ load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 
+# Endpoint of the Messaging API, which can point to a local stand-in for benchmarks
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+
+# Process webhook events on a background worker pool, so /callback returns immediately
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+
+# The users of one delivery are handled concurrently on a pool of WEBHOOK_BATCH_WORKERS threads,
+# at most WEBHOOK_BATCH_CONCURRENCY users of a delivery at a time
+WEBHOOK_BATCH_WORKERS = int(os.getenv("WEBHOOK_BATCH_WORKERS", "8"))
+WEBHOOK_BATCH_CONCURRENCY = int(os.getenv("WEBHOOK_BATCH_CONCURRENCY", "4"))
+
+# Show the LINE loading animation while the reply is generated. STREAMING_REPLY is the former name
+LOADING_ANIMATION = os.getenv("LOADING_ANIMATION", os.getenv("STREAMING_REPLY", "false")).lower() == "true"
+LOADING_SECONDS = int(os.getenv("LOADING_SECONDS", "20"))
+
+# Reply tokens expire shortly after the event, later replies are sent as push messages
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+
+# Prefix every log line with the trace ID of the webhook event being handled
+LOG_TRACE_ID = os.getenv("LOG_TRACE_ID", "false").lower() == "true"
+
+if LOG_TRACE_ID:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s")
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(metrics.TraceIdFilter())
+
 # Create a Flask app
 app = Flask(__name__)
 
 # Create a Line Messaging API configuration
-configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+configuration = Configuration(host=LINE_API_BASE_URL, access_token=CHANNEL_ACCESS_TOKEN)
+handler = QueuedWebhookHandler(
+    CHANNEL_SECRET,
+    async_mode=WEBHOOK_ASYNC,
+    workers=WEBHOOK_WORKERS,
+    max_queue_size=WEBHOOK_QUEUE_SIZE,
+    batch_workers=WEBHOOK_BATCH_WORKERS,
+    batch_concurrency=WEBHOOK_BATCH_CONCURRENCY,
+    deduplicator=EventDeduplicator() if WEBHOOK_DEDUP_ENABLED else None,
+)
 
 api_manager = api_manager.ApiManager()
 
@@ -44,21 +96,97 @@ def callback():
     return 'OK'
 
 
+def collect_stats() -> dict:
+    """Collect the statistics of the webhook queue, caches, and outbound connections"""
+    return {
+        "webhook": handler.stats(),
+        "geocode_cache": map_unit.geocode_cache.stats(),
+        "gazetteer": map_unit.gazetteer.stats(),
+        "http": http_client.stats(),
+        "route_cache": api_manager.tdx_unit.route_cache.stats(),
+        "rule_parser": rule_parser.stats(),
+        "intent_cache": openai_receive_unit.intent_cache.stats(),
+        "itinerary_cache": openai_send_unit.itinerary_cache.stats(),
+        "route_projection": route_projection.stats(),
+        "coalescing": api_manager.stats(),
+        "sessions": api_manager.sessions.stats(),
+        "admission": api_manager.admission.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "circuit_breakers": circuit_breaker.stats(),
+        "hedging": hedging.stats(),
+    }
+
+
+# Define a route for the runtime statistics
+@app.route("/stats", methods=['GET'])
+def stats():
+    return jsonify(collect_stats())
+
+
+# Define a route for the metrics in Prometheus text format
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(collect_stats()), mimetype="text/plain; version=0.0.4")
+
+
+def show_loading(line_bot_api, event):
+    """Start the LINE loading animation in a one-on-one chat"""
+    if getattr(event.source, "user_id", None) is None:
+        return
+    try:
+        line_bot_api.show_loading_animation(
+            ShowLoadingAnimationRequest(chat_id=event.source.user_id, loading_seconds=LOADING_SECONDS))
+    except ApiException as e:
+        app.logger.warning("Failed to show the loading animation: %s", e)
+
+
+def send_text(line_bot_api, event, text):
+    """Reply to an event, or push the message when its reply token has expired"""
+    user_id = getattr(event.source, "user_id", None)
+    elapsed = time.time() - event.timestamp / 1000
+
+    if elapsed < REPLY_TOKEN_TTL or user_id is None:
+        try:
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=text)]))
+            return
+        except ApiException as e:
+            if user_id is None or e.status != 400:
+                raise
+            app.logger.warning("Reply token was rejected, pushing the message instead: %s", e)
+
+    line_bot_api.push_message(PushMessageRequest(to=user_id, messages=[TextMessage(text=text)]))
+
+
 # Define a handler for the MessageEvent
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
+    metrics.new_trace_id(event.webhook_event_id)
+
     with ApiClient(configuration) as api_client:
 
         print("Client text: ", event.message.text)
 
-        response = api_manager.get_result(event.message.text)
+        line_bot_api = MessagingApi(api_client)
+        start = time.perf_counter()
+        timings = {}
+
+        if LOADING_ANIMATION:
+            with metrics.timer('loading', timings):
+                show_loading(line_bot_api, event)
+
+        with metrics.timer('pipeline', timings):
+            response = api_manager.get_result(event.message.text, getattr(event.source, "user_id", None))
 
         response_text = json.loads(response)['data']
 
         print("Response text: ", response_text)
 
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info( ReplyMessageRequest( reply_token=event.reply_token, messages=[TextMessage(text=response_text)]))
+        with metrics.timer('reply', timings):
+            send_text(line_bot_api, event, response_text)
+
+        metrics.log_timings(app.logger, timings, time.perf_counter() - start)
+
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
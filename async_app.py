@@ -0,0 +1,258 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from aiohttp import web
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import (
+    Configuration, AsyncApiClient, AsyncMessagingApi, ApiException, ReplyMessageRequest, PushMessageRequest,
+    ShowLoadingAnimationRequest, TextMessage
+)
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from dotenv import load_dotenv
+import services.api_manager as api_manager
+import services.map_unit as map_unit
+import services.http_client as http_client
+import services.rule_parser as rule_parser
+import services.openai_receive_unit as openai_receive_unit
+import services.openai_send_unit as openai_send_unit
+import services.route_projection as route_projection
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+import services.hedging as hedging
+import services.metrics as metrics
+from services.webhook_queue import group_events
+from services.event_dedup import EventDeduplicator, WEBHOOK_DEDUP_ENABLED
+
+# Load environment variables
+load_dotenv()
+
+CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+
+# Endpoint of the Messaging API, which can point to a local stand-in for benchmarks
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+
+# Show the LINE loading animation while the reply is generated. STREAMING_REPLY is the former name
+LOADING_ANIMATION = os.getenv("LOADING_ANIMATION", os.getenv("STREAMING_REPLY", "false")).lower() == "true"
+LOADING_SECONDS = int(os.getenv("LOADING_SECONDS", "20"))
+
+# Reply tokens expire shortly after the event, later replies are sent as push messages
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+
+# At most WEBHOOK_BATCH_CONCURRENCY users of one delivery are handled at a time
+WEBHOOK_BATCH_CONCURRENCY = int(os.getenv("WEBHOOK_BATCH_CONCURRENCY", "4"))
+
+# Address the server listens on when started with `python async_app.py`
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+
+# Prefix every log line with the trace ID of the webhook event being handled
+LOG_TRACE_ID = os.getenv("LOG_TRACE_ID", "false").lower() == "true"
+
+if LOG_TRACE_ID:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s")
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(metrics.TraceIdFilter())
+
+logger = logging.getLogger(__name__)
+
+# Create a Line Messaging API configuration
+configuration = Configuration(host=LINE_API_BASE_URL, access_token=CHANNEL_ACCESS_TOKEN)
+parser = WebhookParser(CHANNEL_SECRET)
+
+api_manager = api_manager.ApiManager()
+
+# Drops redeliveries of the events already received
+deduplicator = EventDeduplicator() if WEBHOOK_DEDUP_ENABLED else None
+
+# Events being handled, so their tasks are not garbage collected before they finish
+tasks = set()
+counters = {"batches": 0, "received": 0, "processed": 0, "failed": 0}
+
+
+async def callback(request: web.Request) -> web.Response:
+    # get X-Line-Signature header value
+    signature = request.headers.get('X-Line-Signature', '')
+
+    # get request body as text
+    body = await request.text()
+    logger.info("Request body: " + body)
+
+    # parse webhook body
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        logger.info("Invalid signature. Please check your channel access token/channel secret.")
+        raise web.HTTPBadRequest()
+
+    received = time.perf_counter()
+    if events:
+        counters["batches"] += 1
+        metrics.webhook_batch_size.observe(len(events))
+
+    if deduplicator is not None:
+        events = await deduplicator.filter_async(events)
+
+    messages = [
+        event for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent)
+    ]
+    counters["received"] += len(messages)
+
+    # Handle each user's messages in order as a background task, so LINE gets its response immediately
+    slots = asyncio.Semaphore(WEBHOOK_BATCH_CONCURRENCY)
+    for group in group_events(messages):
+        task = asyncio.create_task(handle_group(request.app["line_bot_api"], group, slots, received))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    return web.Response(text='OK')
+
+
+def collect_stats() -> dict:
+    """Collect the statistics of the event tasks, caches, and outbound connections"""
+    return {
+        "webhook": {
+            "async_mode": True,
+            "in_flight": len(tasks),
+            **counters,
+            "dedup": deduplicator.stats() if deduplicator is not None else {},
+        },
+        "geocode_cache": map_unit.geocode_cache.stats(),
+        "gazetteer": map_unit.gazetteer.stats(),
+        "http": http_client.stats(),
+        "route_cache": api_manager.tdx_unit.route_cache.stats(),
+        "rule_parser": rule_parser.stats(),
+        "intent_cache": openai_receive_unit.intent_cache.stats(),
+        "itinerary_cache": openai_send_unit.itinerary_cache.stats(),
+        "route_projection": route_projection.stats(),
+        "coalescing": api_manager.stats(),
+        "sessions": api_manager.sessions.stats(),
+        "admission": api_manager.admission.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "circuit_breakers": circuit_breaker.stats(),
+        "hedging": hedging.stats(),
+    }
+
+
+async def stats(request: web.Request) -> web.Response:
+    # The on-disk stores are counted with SQLite queries, which run in a worker thread
+    return web.json_response(await asyncio.to_thread(collect_stats))
+
+
+async def prometheus_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(await asyncio.to_thread(collect_stats)),
+                        headers={"Content-Type": "text/plain; version=0.0.4"})
+
+
+async def show_loading(line_bot_api: AsyncMessagingApi, event):
+    """Start the LINE loading animation in a one-on-one chat"""
+    if getattr(event.source, "user_id", None) is None:
+        return
+    try:
+        await line_bot_api.show_loading_animation(
+            ShowLoadingAnimationRequest(chat_id=event.source.user_id, loading_seconds=LOADING_SECONDS))
+    except ApiException as e:
+        logger.warning("Failed to show the loading animation: %s", e)
+
+
+async def send_text(line_bot_api: AsyncMessagingApi, event, text):
+    """Reply to an event, or push the message when its reply token has expired"""
+    user_id = getattr(event.source, "user_id", None)
+    elapsed = time.time() - event.timestamp / 1000
+
+    if elapsed < REPLY_TOKEN_TTL or user_id is None:
+        try:
+            await line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=text)]))
+            return
+        except ApiException as e:
+            if user_id is None or e.status != 400:
+                raise
+            logger.warning("Reply token was rejected, pushing the message instead: %s", e)
+
+    await line_bot_api.push_message(PushMessageRequest(to=user_id, messages=[TextMessage(text=text)]))
+
+
+async def handle_message(line_bot_api: AsyncMessagingApi, event):
+    metrics.new_trace_id(event.webhook_event_id)
+
+    start = time.perf_counter()
+    timings = {}
+
+    try:
+        print("Client text: ", event.message.text)
+
+        if LOADING_ANIMATION:
+            with metrics.timer('loading', timings):
+                await show_loading(line_bot_api, event)
+
+        with metrics.timer('pipeline', timings):
+            response = await api_manager.get_result_async(event.message.text, getattr(event.source, "user_id", None))
+
+        response_text = json.loads(response)['data']
+
+        print("Response text: ", response_text)
+
+        with metrics.timer('reply', timings):
+            await send_text(line_bot_api, event, response_text)
+
+        metrics.log_timings(logger, timings, time.perf_counter() - start)
+
+        counters["processed"] += 1
+    except Exception:
+        counters["failed"] += 1
+        logger.exception("Failed to handle the webhook event")
+        if deduplicator is not None:
+            await deduplicator.release_async(event)
+
+
+async def handle_group(line_bot_api: AsyncMessagingApi, group: list, slots: asyncio.Semaphore, received: float):
+    """
+    Handle the messages of one user in order, once their delivery has a free slot.
+
+    :param group: The message events of the user.
+    :param slots: The semaphore limiting the users of the delivery handled at a time.
+    :param received: The time.perf_counter() value when the delivery arrived.
+    """
+    async with slots:
+        for event in group:
+            await handle_message(line_bot_api, event)
+            metrics.webhook_event_duration.observe(time.perf_counter() - received)
+
+
+async def open_clients(app: web.Application):
+    # The clients are bound to the running event loop, so they are created on startup
+    app["api_client"] = AsyncApiClient(configuration)
+    app["line_bot_api"] = AsyncMessagingApi(app["api_client"])
+
+
+async def close_clients(app: web.Application):
+    # Let the events in progress send their replies before the clients are closed
+    if tasks:
+        await asyncio.wait(list(tasks))
+    await app["api_client"].close()
+    await http_client.close_async_client()
+
+
+def create_app() -> web.Application:
+    """
+    Create the aiohttp application, which handles each conversation as a task on one event loop
+    instead of holding a thread while it waits on OpenAI, Google and TDX.
+
+    :return: The application.
+    """
+    app = web.Application()
+    app.on_startup.append(open_clients)
+    app.on_cleanup.append(close_clients)
+    app.router.add_post("/callback", callback)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", prometheus_metrics)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=HOST, port=PORT)
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class Upstream:
+    """Latency and failure settings of one stand-in upstream"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.requests = 0
+
+    def delay(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def should_fail(self) -> bool:
+        return random.random() < self.failure_rate
+
+
+def geocode_response(address: str) -> dict:
+    """Return a stable coordinate around Taipei for an address"""
+    digest = hashlib.sha256(address.encode()).digest()
+    return {
+        "status": "OK",
+        "results": [{"geometry": {"location": {
+            "lat": 25.0 + digest[0] / 2550,
+            "lng": 121.45 + digest[1] / 2550,
+        }}}],
+    }
+
+
+def routing_response(top: int = 1) -> dict:
+    """Return up to three candidate routes departing five minutes from now"""
+    start = datetime.now() + timedelta(minutes=5)
+
+    def at(seconds: int) -> str:
+        return (start + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S")
+
+    def walk(begin: int, end: int, name: str) -> dict:
+        return {
+            "type": "pedestrian",
+            "actions": [{"action": "depart", "duration": end - begin}, {"action": "arrive", "duration": 0}],
+            "travelSummary": {"duration": end - begin, "length": (end - begin) * 1.375},
+            "departure": {"time": at(begin), "place": {"type": "place", "location": {"lat": 25.0, "lng": 121.5}}},
+            "arrival": {"time": at(end), "place": {"name": name, "location": {"lat": 25.04, "lng": 121.51}}},
+            "polyline": "BFoz5xJ67i1B1B7PzIhaxL7Y" * 20,
+        }
+
+    def ride(begin: int, end: int, origin: str, destination: str, mode: str, line: str, headsign: str) -> dict:
+        return {
+            "type": "transit",
+            "travelSummary": {"duration": end - begin},
+            "departure": {"time": at(begin), "place": {"name": origin, "location": {"lat": 25.04, "lng": 121.51}}},
+            "arrival": {"time": at(end), "place": {"name": destination, "location": {"lat": 25.03, "lng": 121.56}}},
+            "transport": {"mode": mode, "name": line, "headsign": headsign},
+            "polyline": "BFoz5xJ67i1B1B7PzIhaxL7Y" * 40,
+        }
+
+    def route(travel_time: int, transfers: int, price: int, sections: list) -> dict:
+        return {
+            "travel_time": travel_time, "start_time": at(0), "end_time": at(travel_time),
+            "transfers": transfers, "total_price": price, "sections": sections,
+        }
+
+    routes = [
+        route(1380, 0, 25, [
+            walk(0, 300, "台北車站"),
+            ride(300, 1380, "台北車站", "台北101/世貿", "MRT", "淡水信義線", "象山"),
+        ]),
+        route(2100, 1, 15, [
+            walk(0, 240, "台北車站(忠孝)"),
+            ride(240, 1200, "台北車站(忠孝)", "市政府", "BUS", "307", "莒光"),
+            ride(1260, 2100, "市政府", "台北101", "BUS", "信義幹線", "松山車站"),
+        ]),
+        route(1500, 1, 30, [
+            walk(0, 180, "台北車站"),
+            ride(180, 660, "台北車站", "忠孝復興", "MRT", "板南線", "南港展覽館"),
+            ride(780, 1500, "忠孝復興", "台北101/世貿", "MRT", "文湖線", "動物園"),
+        ]),
+    ]
+
+    return {"result": "success", "data": {"routes": routes[:max(1, top)]}}
+
+
+def chat_completion_content(messages: list) -> str:
+    """Answer an extraction prompt with JSON, and any other prompt with an itinerary"""
+    prompt = messages[-1]["content"] if messages else ""
+    if "提取起點" in prompt:
+        return json.dumps({"origin": "台北車站", "destination": "台北101", "preference": "無"}, ensure_ascii=False)
+    return "你好！搭捷運就能到囉。\n1. 步行 5 分鐘到台北車站。\n2. 搭乘捷運淡水信義線到台北101/世貿。"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves the OpenAI, Geocoding, TDX and LINE endpoints used by the service units"""
+
+    protocol_version = "HTTP/1.1"
+    upstreams = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status: int, data):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, content: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for index in range(0, len(content), 8):
+            chunk = {
+                "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": "gpt-3.5-turbo",
+                "choices": [{"index": 0, "delta": {"content": content[index:index + 8]}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def route(self, method: str):
+        path = urlsplit(self.path).path
+        body = self.read_body()
+
+        if path.endswith("/chat/completions"):
+            name = "openai"
+        elif path.endswith("/geocode/json"):
+            name = "geocode"
+        elif path.endswith("/openid-connect/token"):
+            name = "tdx_token"
+        elif path.endswith("/maas/routing"):
+            name = "tdx_routing"
+        elif path.startswith("/v2/bot/"):
+            name = "line"
+        else:
+            self.send_json(404, {"error": "not found"})
+            return
+
+        upstream = self.upstreams[name]
+        upstream.requests += 1
+        upstream.delay()
+
+        if upstream.should_fail():
+            self.send_json(503, {"error": "injected failure"})
+            return
+
+        if name == "openai":
+            request_data = json.loads(body or b"{}")
+            content = chat_completion_content(request_data.get("messages", []))
+            if request_data.get("stream"):
+                self.send_stream(content)
+                return
+            self.send_json(200, {
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                "model": "gpt-3.5-turbo",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        elif name == "geocode":
+            address = parse_qs(urlsplit(self.path).query).get("address", [""])[0]
+            self.send_json(200, geocode_response(address))
+        elif name == "tdx_token":
+            self.send_json(200, {"access_token": "bench-token", "expires_in": 86400})
+        elif name == "tdx_routing":
+            top = parse_qs(urlsplit(self.path).query).get("top", ["1"])[0]
+            self.send_json(200, routing_response(int(top)))
+        elif path.endswith("/message/reply") or path.endswith("/message/push"):
+            self.send_json(200, {"sentMessages": [{"id": str(upstream.requests), "quoteToken": "bench"}]})
+        else:
+            self.send_json(202, {})
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+
+def start(upstreams: dict, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the stand-in server in a background thread.
+
+    :param upstreams: A dictionary mapping 'openai', 'geocode', 'tdx_token', 'tdx_routing' and 'line' to Upstream settings.
+    :param host: The address to listen on.
+    :param port: The port to listen on, 0 picks a free one.
+    :return: The running server.
+    """
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"upstreams": upstreams})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def environment(server: ThreadingHTTPServer) -> dict:
+    """Return the environment variables that point the service units at the stand-in server"""
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    return {
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "GOOGLE_GEOCODE_URL": f"{base_url}/maps/api/geocode/json",
+        "TDX_AUTH_URL": f"{base_url}/auth/realms/TDXConnect/protocol/openid-connect/token",
+        "TDX_ROUTING_URL": f"{base_url}/api/maas/routing",
+        "LINE_API_BASE_URL": base_url,
+    }
+
+
+if __name__ == "__main__":
+    server = start({name: Upstream() for name in ("openai", "geocode", "tdx_token", "tdx_routing", "line")}, port=8900)
+    for key, value in environment(server).items():
+        print(f"{key}={value}")
+    threading.Event().wait()
@@ -0,0 +1,187 @@
+"""
+Replay signed webhook deliveries against /callback with every upstream replaced by a local stand-in.
+
+Example:
+    python -m benchmarks.run_benchmark --events 200 --concurrency 16 --openai-latency 0.8 --geocode-latency 0.1
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import hmac
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import mock_servers
+
+CHANNEL_SECRET = "bench-channel-secret"
+
+UPSTREAMS = ("openai", "geocode", "tdx_token", "tdx_routing", "line")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100, help="number of webhook deliveries to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of deliveries sent at the same time")
+    parser.add_argument("--batch-size", type=int, default=1, help="number of events in each delivery, from different users")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(__file__), "corpus.txt"),
+                        help="file with one user message per line")
+    parser.add_argument("--render-mode", default="template", choices=["template", "polish", "llm"])
+    parser.add_argument("--async-webhook", action="store_true", help="acknowledge deliveries before processing")
+    parser.add_argument("--cold", action="store_true", help="disable the geocode, route and intent caches")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of every upstream latency")
+    for name in UPSTREAMS:
+        option = name.replace("_", "-")
+        parser.add_argument(f"--{option}-latency", type=float, default=0.0, help=f"{name} latency in seconds")
+        parser.add_argument(f"--{option}-failure-rate", type=float, default=0.0, help=f"{name} failure rate")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace, server) -> None:
+    """Point the service units at the stand-in server; must run before the app is imported"""
+    os.environ.update(mock_servers.environment(server))
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-access-token",
+        "OPENAI_API_KEY": "bench-openai-key",
+        "GOOGLE_MAP_API_KEY": "bench-google-key",
+        "TDX_CLIENT_ID": "bench-client",
+        "TDX_CLIENT_SECRET": "bench-secret",
+        "GEOCODE_CACHE_PATH": "",
+        "ROUTE_RENDER_MODE": args.render_mode,
+        "WEBHOOK_ASYNC": "true" if args.async_webhook else "false",
+        "WEBHOOK_QUEUE_SIZE": str(max(args.events * args.batch_size, 100)),
+    })
+    if args.cold:
+        os.environ.update({"GEOCODE_CACHE_SIZE": "0", "ROUTE_CACHE_SIZE": "0", "INTENT_CACHE_SIZE": "0"})
+
+
+def build_event(index: int, text: str) -> dict:
+    """Build a text message event of its own user"""
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": f"Ubench{index:08d}"},
+        "webhookEventId": f"01BENCH{index:019d}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"bench-reply-token-{index}",
+        "message": {"type": "text", "id": str(index), "quoteToken": "q", "text": text},
+    }
+
+
+def build_delivery(indexes: range, corpus: list) -> tuple:
+    """
+    Build a signed webhook body with one text message event per index, taken from the corpus.
+
+    :return: A (body, signature) tuple.
+    """
+    body = json.dumps({
+        "destination": "Ubench",
+        "events": [build_event(index, corpus[index % len(corpus)]) for index in indexes],
+    }, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    args = parse_args()
+
+    upstreams = {
+        name: mock_servers.Upstream(
+            latency=getattr(args, f"{name}_latency"),
+            jitter=args.jitter,
+            failure_rate=getattr(args, f"{name}_failure_rate"),
+        )
+        for name in UPSTREAMS
+    }
+    server = mock_servers.start(upstreams)
+    configure_environment(args, server)
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    import app as bot
+    import services.metrics as metrics
+
+    # Keep every stage sample, so percentiles are exact rather than bucket bounds
+    samples = {}
+    samples_lock = threading.Lock()
+    observe = metrics.stage_duration.observe
+
+    def record(value, **labels):
+        with samples_lock:
+            samples.setdefault(labels.get("stage"), []).append(value)
+        observe(value, **labels)
+
+    metrics.stage_duration.observe = record
+
+    # Completion times of the events, measured from the arrival of their delivery
+    observe_event = metrics.webhook_event_duration.observe
+
+    def record_event(value, **labels):
+        with samples_lock:
+            samples.setdefault("event", []).append(value)
+        observe_event(value, **labels)
+
+    metrics.webhook_event_duration.observe = record_event
+
+    with open(args.corpus, encoding="utf-8") as corpus_file:
+        corpus = [line.strip() for line in corpus_file if line.strip()]
+    deliveries = [
+        build_delivery(range(index * args.batch_size, (index + 1) * args.batch_size), corpus)
+        for index in range(args.events)
+    ]
+
+    local = threading.local()
+
+    def send(delivery):
+        if not hasattr(local, "client"):
+            local.client = bot.app.test_client()
+        body, signature = delivery
+        start = time.perf_counter()
+        response = local.client.post("/callback", data=body.encode(), headers={
+            "X-Line-Signature": signature, "Content-Type": "application/json"})
+        record(time.perf_counter() - start, stage="callback")
+        return response.status_code
+
+    # The bot prints every message and reply, keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            statuses = list(executor.map(send, deliveries))
+        if args.async_webhook:
+            bot.handler.queue.join()
+        elapsed = time.perf_counter() - start
+
+    events = args.events * args.batch_size
+    print(f"deliveries: {args.events}, events: {events}, concurrency: {args.concurrency}, elapsed: {elapsed:.2f}s, "
+          f"throughput: {events / elapsed:.1f} events/s")
+    print(f"callback status codes: { {code: statuses.count(code) for code in sorted(set(statuses))} }")
+    print()
+    print(f"{'stage':<10} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, values in sorted(samples.items()):
+        print(f"{stage:<10} {len(values):>7} {statistics.mean(values) * 1000:>7.1f}ms "
+              f"{percentile(values, 0.50) * 1000:>7.1f}ms {percentile(values, 0.95) * 1000:>7.1f}ms "
+              f"{percentile(values, 0.99) * 1000:>7.1f}ms")
+    print()
+    print("upstream requests: " + ", ".join(f"{name}={upstream.requests}" for name, upstream in upstreams.items()))
+    failures = {f"{labels['stage']}/{labels['reason']}": value for labels, value in metrics.stage_errors.items()}
+    if failures:
+        print(f"failures: {failures}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import threading
+from dotenv import load_dotenv
+import os
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Messages are answered concurrently up to an adaptive limit, between ADMISSION_MIN_LIMIT and
+# ADMISSION_MAX_LIMIT. The limit shrinks by ADMISSION_BACKOFF, at most once per limit's worth of answers,
+# while the smoothed latency of an answer is above ADMISSION_TARGET_LATENCY seconds, and grows back
+# while it is below.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_INITIAL_LIMIT = float(os.getenv("ADMISSION_INITIAL_LIMIT", "50"))
+ADMISSION_MIN_LIMIT = float(os.getenv("ADMISSION_MIN_LIMIT", "4"))
+ADMISSION_MAX_LIMIT = float(os.getenv("ADMISSION_MAX_LIMIT", "500"))
+ADMISSION_TARGET_LATENCY = float(os.getenv("ADMISSION_TARGET_LATENCY", "10"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.9"))
+
+# Weight of the newest latency in the smoothed latency
+LATENCY_SMOOTHING = 0.2
+
+
+class AdaptiveLimiter:
+    """
+    A thread-safe limit on concurrent pipelines that adapts to their latency (AIMD).
+
+    Each completed pipeline updates an exponentially smoothed latency. Above the target, the limit
+    is multiplied by backoff, at most once per limit's worth of completions, so a burst of slow
+    answers that all started under the old limit counts as one signal. Below it, the limit grows by
+    one per limit's worth of completions, as long as at least half of it was in use. Callers over
+    the limit are shed instead of queued.
+    """
+
+    def __init__(self, initial_limit: float = ADMISSION_INITIAL_LIMIT, min_limit: float = ADMISSION_MIN_LIMIT,
+                 max_limit: float = ADMISSION_MAX_LIMIT, target_latency: float = ADMISSION_TARGET_LATENCY,
+                 backoff: float = ADMISSION_BACKOFF, enabled: bool = ADMISSION_ENABLED):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._limit = min(max(initial_limit, min_limit), max_limit)
+        self._in_flight = 0
+        self._latency = None
+        self._completions = 0
+        self._last_decrease = None
+        self._counters = {"admitted": 0, "shed": 0, "decreases": 0}
+
+    def try_acquire(self) -> bool:
+        """
+        Admit a pipeline if the limit allows it.
+
+        :return: True if the caller may start, in which case it must call release(); False if it is shed.
+        """
+        with self._lock:
+            if self.enabled and self._in_flight >= int(self._limit):
+                self._counters["shed"] += 1
+                return False
+            self._in_flight += 1
+            self._counters["admitted"] += 1
+            return True
+
+    def release(self, latency: float):
+        """
+        Finish an admitted pipeline and adapt the limit to its latency.
+
+        :param latency: The seconds the pipeline took.
+        """
+        with self._lock:
+            utilized = self._in_flight >= self._limit / 2
+            self._in_flight -= 1
+            self._completions += 1
+
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+
+            if self._latency > self.target_latency:
+                # Wait for the pipelines admitted under the old limit to finish before decreasing again
+                if self._last_decrease is None or self._completions - self._last_decrease >= self._limit:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._last_decrease = self._completions
+                    self._counters["decreases"] += 1
+            elif utilized:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def stats(self) -> dict:
+        """Return the current limit, the pipelines in flight, the smoothed latency and the counters"""
+        with self._lock:
+            total = self._counters["admitted"] + self._counters["shed"]
+            return {
+                "enabled": self.enabled,
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "latency": self._latency or 0.0,
+                "target_latency": self.target_latency,
+                **self._counters,
+                "shed_ratio": self._counters["shed"] / total if total else 0.0,
+            }
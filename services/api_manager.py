@@ -1,99 +1,454 @@
 import json
+import time
+import unicodedata
 import services.openai_receive_unit as openai_receive_unit
 import services.map_unit as map_unit
 import services.tdx_unit as tdx_unit
 import services.openai_send_unit as openai_send_unit
+import services.rule_parser as rule_parser
+import services.route_ranking as route_ranking
+import services.metrics as metrics
+import services.circuit_breaker as circuit_breaker
+from services.pipeline import StageResult, Intent, Locations
+from services.admission import AdaptiveLimiter
+from services.rate_limiter import RateLimitExceeded
+from services.singleflight import SingleFlight
+from services.session_store import Session, SessionStore
+
+
+# Friendly replies of the failure branches
+TOO_LONG_MESSAGE = '''抱歉，你的訊息有點太長了，我小小的腦袋裝不下QQ\n\n
+可以麻煩你用簡短的文字告訴我，你的起點、目的地，以及希望省錢還是省時間嗎？'''
+
+NOT_UNDERSTOOD_MESSAGE = '''抱歉，我沒有聽懂你的起點及目的地，分別在哪裡QQ\n\n
+可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
+
+OPENAI_ERROR_MESSAGE = '''抱歉，連接 open ai 時出現問題。錯誤訊息：{message}'''
+
+GEOCODE_NOT_FOUND_MESSAGE = '''抱歉，你的起點及目的地，似乎有無法在地圖上搜尋到的地方QQ\n\n
+可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
+
+ROUTE_NOT_FOUND_MESSAGE = '''抱歉，看起來這超出了我的能力範圍，無法給你幫助QQ\n\n
+你可以試試這些方法，幫助我更好地找到正確的路線：\n\n
+1. 對地點更詳細的描述：比起**市政府**，**臺南市政府**會是更好的選擇！\n
+2. 避免輸入國外地點：我只能協助規劃臺灣境內的路線\n
+3. 起終點附近的大眾運輸：有些地方大眾運輸到不了，我就沒辦法規劃了\n\n
+確認過上面幾點後，可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
+
+TDX_ERROR_MESSAGE = '''抱歉，連接 TDX 時出現問題。錯誤訊息：{message}'''
+
+RENDER_ERROR_MESSAGE = '''抱歉，小幫手在產生交通路線時，出了一點問題QQ\n\n
+可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
+
+BUSY_MESSAGE = '''抱歉，現在查詢路線的人太多了，小幫手忙不過來QQ\n\n
+請稍等一下，再告訴我一次：你的起點、目的地，以及希望省錢還是省時間喔！'''
+
+
+def failure(stage: str, reason: str, text: str) -> str:
+    """
+    Count a handled failure and build the reply shown to the user.
+
+    :param stage: The pipeline stage that failed.
+    :param reason: The failure branch.
+    :param text: The friendly message.
+    :return: A JSON-formatted string containing the message.
+    """
+    metrics.record_failure(stage, reason)
+    return json.dumps({'result': False, 'data': text})
+
+
+def shed() -> str:
+    """Build the instant reply for a message that was not admitted because the bot is overloaded"""
+    return failure('admission', 'shed', BUSY_MESSAGE)
+
+
+def busy() -> str:
+    """
+    Build the reply for a request an upstream was too busy to take, after waiting in its queue.
+    The failure is already counted by the timer of the stage that was rate limited.
+    """
+    return json.dumps({'result': False, 'data': BUSY_MESSAGE})
+
+
+def reason_of(result: StageResult, reason: str) -> str:
+    """Return the failure branch of a stage, telling the fast failures of an open circuit breaker apart"""
+    return 'circuit_open' if circuit_breaker.is_open_message(result.message) else reason
+
+
+def check_input(input_string: str) -> str:
+    """Return the failure reply if the input is too long, otherwise None"""
+    if len(input_string) > 200:
+        return failure('input', 'too_long', TOO_LONG_MESSAGE)
+    return None
+
+
+def check_intent(intent: StageResult) -> str:
+    """Return the failure reply if the extraction failed, otherwise None"""
+    if intent.result:
+        return None
+    if intent.message.lower() == 'origin or destination is not correct':
+        return failure('extract', 'not_understood', NOT_UNDERSTOOD_MESSAGE)
+    return failure('extract', reason_of(intent, 'openai_error'), OPENAI_ERROR_MESSAGE.format(message=intent.message))
+
+
+def check_locations(locations: StageResult) -> str:
+    """Return the failure reply if the geocoding failed, otherwise None"""
+    if locations.result:
+        return None
+    return failure('geocode', reason_of(locations, 'not_found'), GEOCODE_NOT_FOUND_MESSAGE)
+
+
+def check_route(route: StageResult) -> str:
+    """Return the failure reply if the routing failed, otherwise None"""
+    if route.result:
+        return None
+    if route.message == 'Route not found':
+        return failure('route', 'not_found', ROUTE_NOT_FOUND_MESSAGE)
+    return failure('route', reason_of(route, 'tdx_error'), TDX_ERROR_MESSAGE.format(message=route.message))
+
+
+def check_itinerary(itinerary: StageResult) -> str:
+    """Return the failure reply if the rendering failed, otherwise None"""
+    if itinerary.result:
+        return None
+    return failure('render', reason_of(itinerary, 'openai_error'), RENDER_ERROR_MESSAGE)
+
+
+def normalize_input(input_string: str) -> str:
+    """Normalize a message into a coalescing key, so that width and spacing variants share a call"""
+    text = unicodedata.normalize("NFKC", input_string)
+    return "".join(text.split()).lower()
+
+
+def rank_session(session: Session, order: str) -> tuple:
+    """
+    Rank the route candidates of a session, updating the preference to match the ranking.
+
+    :return: A tuple of the ranked Route and the updated Intent.
+    """
+    intent = session.intent
+    preference = route_ranking.ORDER_PREFERENCES.get(order, intent.preference)
+    return route_ranking.rank(session.route, order), Intent(intent.origin, intent.destination, preference)
+
+
+def reverse_session(session: Session) -> tuple:
+    """
+    Swap the origin and destination of a session for the way back.
+
+    :return: A tuple of the reversed Intent and Locations.
+    """
+    intent, locations = session.intent, session.locations
+    return (
+        Intent(intent.destination, intent.origin, intent.preference),
+        Locations(locations.destination, locations.origin, locations.gc),
+    )
+
+
+def needs_replan(session: Session, intent: Intent) -> bool:
+    """Check if a changed preference cannot be answered from the stored candidates"""
+    return (
+        len(session.route.data.get("routes", [])) < 2
+        and map_unit.process_text(intent.preference) != session.locations.gc
+    )
+
+
+def with_preference(locations: Locations, preference: str) -> Locations:
+    """Return the locations with the TDX preference code of another preference"""
+    return Locations(locations.origin, locations.destination, map_unit.process_text(preference))
+
+
+def get_route_key(locations: Locations) -> tuple:
+    """Return the (origin, destination, gc) tuple identifying calls that share a route"""
+    return tuple(locations.origin), tuple(locations.destination), locations.gc
 
 
 class ApiManager:
     def __init__(self):
         self.tdx_unit = tdx_unit.TdxUnit()
 
-    def get_result(self, input_string: str) -> str:
+        # Concurrent identical messages share one pipeline run, and concurrent messages
+        # resolving to the same places share one route and itinerary
+        self.input_flights = SingleFlight()
+        self.route_flights = SingleFlight()
+
+        # The last answered question of each user, for follow-up questions
+        self.sessions = SessionStore()
+
+        # Messages beyond the adaptive concurrency limit get the busy reply instead of the pipeline
+        self.admission = AdaptiveLimiter()
+
+    def get_result(self, input_string: str, user_id: str = None) -> str:
         """
         Manages the workflow of extracting user inputs, validating them, and returning final results
         by integrating OpenAI, Map API, and TDX API.
 
         :param input_string: The user's input string.
+        :param user_id: The LINE user ID, which enables follow-up questions about the last route.
         :return: A JSON-formatted string containing the result.
         """
 
         # Validate input string length
-        if len(input_string) > 200:
-            return json.dumps({
-                'result': False,
-                'data': '''抱歉，你的訊息有點太長了，我小小的腦袋裝不下QQ\n\n
-可以麻煩你用簡短的文字告訴我，你的起點、目的地，以及希望省錢還是省時間嗎？'''
-            })
+        error = check_input(input_string)
+        if error:
+            return error
 
-        # Call OpenAI to extract origin, destination, and preference
-        AI_to_MAP = openai_receive_unit.get_result(input_string)
+        # Reply at once when overloaded, rather than miss the reply deadline of every user
+        if not self.admission.try_acquire():
+            return shed()
 
-        # print("AI_to_MAP: ", json.loads(AI_to_MAP))
+        start = time.perf_counter()
+        try:
+            return self.answer(input_string, user_id)
+        finally:
+            self.admission.release(time.perf_counter() - start)
 
-        if not json.loads(AI_to_MAP)['result']:
-            message = json.loads(AI_to_MAP)['message']
-            if message == 'origin or destination is not correct':
-                return json.dumps({
-                    'result': False,
-                    'data': '''抱歉，我沒有聽懂你的起點及目的地，分別在哪裡QQ\n\n
-可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
-                })
-            else:
-                return json.dumps({
-                    'result': False,
-                    'data': f'''抱歉，連接 open ai 時出現問題。錯誤訊息：{message}'''
-                })
+    def answer(self, input_string: str, user_id: str = None) -> str:
+        """
+        Answer an admitted message, as a follow-up of the user's last question or with the full pipeline.
+
+        :param input_string: The user's input string.
+        :param user_id: The LINE user ID.
+        :return: A JSON-formatted string containing the result.
+        """
+        try:
+            # Answer follow-ups such as "那最快的呢?" or "我要回程" from the user's last question
+            session, kind = self.get_follow_up(input_string, user_id)
+            if session is not None:
+                return self.follow_up(user_id, session, kind)
+
+            result, session = self.input_flights.do(normalize_input(input_string), self.process, input_string)
+
+        except RateLimitExceeded:
+            # The request waited as long as it may for a saturated upstream
+            return busy()
+
+        if session is not None and user_id is not None:
+            self.sessions.set(user_id, session)
+        return result
+
+    def process(self, input_string: str) -> tuple:
+        """
+        Run the pipeline for one message, coalescing the route stage with other messages.
+
+        :param input_string: The user's input string.
+        :return: A tuple of the JSON result and the Session to keep, or None on failure.
+        """
+        # Call OpenAI to extract origin, destination, and preference
+        with metrics.timer('extract'):
+            intent = openai_receive_unit.extract_intent(input_string)
+
+        error = check_intent(intent)
+        if error:
+            return error, None
 
         # Call Map API to validate the input
-        MAP_to_TDX = map_unit.get_result(AI_to_MAP)
+        with metrics.timer('geocode'):
+            locations = map_unit.resolve(intent.data)
 
-        # print("MAP_to_TDX: ", json.loads(MAP_to_TDX))
+        error = check_locations(locations)
+        if error:
+            return error, None
 
-        if not json.loads(MAP_to_TDX)['result']:
-            return json.dumps({
-                'result': False,
-                'data': '''抱歉，你的起點及目的地，似乎有無法在地圖上搜尋到的地方QQ\n\n
-可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
-            })
+        result, route = self.route_flights.do(get_route_key(locations.data), self.plan, locations.data, intent.data)
+        return result, Session(intent.data, locations.data, route) if route is not None else None
+
+    def plan(self, locations: Locations, intent: Intent) -> tuple:
+        """
+        Get the route candidates between resolved locations and render the itinerary of the first one.
 
+        :return: A tuple of the JSON result and the Route, or None on failure.
+        """
         # Call TDX API to get the route
-        TDX_to_AI = self.tdx_unit.get_result(MAP_to_TDX)
+        with metrics.timer('route'):
+            route = self.tdx_unit.get_route(locations)
 
-        # print("TDX_to_AI: ", json.loads(TDX_to_AI))
+        error = check_route(route)
+        if error:
+            return error, None
 
-        if not json.loads(TDX_to_AI)['result']:
-            message = json.loads(TDX_to_AI)['message']
-            if message == 'Route not found':
-                return json.dumps({
-                    'result': False,
-                    'data': '''抱歉，看起來這超出了我的能力範圍，無法給你幫助QQ\n\n
-你可以試試這些方法，幫助我更好地找到正確的路線：\n\n
-1. 對地點更詳細的描述：比起**市政府**，**臺南市政府**會是更好的選擇！\n
-2. 避免輸入國外地點：我只能協助規劃臺灣境內的路線\n
-3. 起終點附近的大眾運輸：有些地方大眾運輸到不了，我就沒辦法規劃了\n\n
-確認過上面幾點後，可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
-                })
-            else:
-                return json.dumps({
-                    'result': False,
-                    'data': f'''抱歉，連接 TDX 時出現問題。錯誤訊息：{message}'''
-                })
-
-        # Combine OpenAI and TDX results for final response
-        TDX_to_AI = f"{json.loads(AI_to_MAP)['data']}{TDX_to_AI}"
-
-        # Call OpenAI to generate the final user-friendly response
-        AI_to_USER = openai_send_unit.get_result(TDX_to_AI)
-
-        if not json.loads(AI_to_USER)['result']:
-            return json.dumps({
-                'result': False,
-                'data': '''抱歉，小幫手在產生交通路線時，出了一點問題QQ\n\n
-可以再告訴我一次：你的起點、目的地，以及希望省錢還是省時間嗎？'''
-            })
+        # Put the candidate that best matches the preference first
+        ranked = route_ranking.rank(route.data, route_ranking.PREFERENCE_ORDERS.get(intent.preference, "time"))
+
+        # Render the final user-friendly response, locally or with OpenAI
+        with metrics.timer('render'):
+            itinerary = openai_send_unit.render(ranked, intent)
+
+        error = check_itinerary(itinerary)
+        if error:
+            return error, None
+
+        return itinerary.to_json(), ranked
+
+    def get_follow_up(self, input_string: str, user_id: str) -> tuple:
+        """
+        Check whether a message is a follow-up of the user's last question.
+
+        :param input_string: The user's input string.
+        :param user_id: The LINE user ID.
+        :return: A tuple of the user's Session and the follow-up kind, or (None, None).
+        """
+        if user_id is None:
+            return None, None
+
+        kind = rule_parser.parse_follow_up(input_string)
+        if kind is None:
+            return None, None
+
+        session = self.sessions.get(user_id)
+        if session is None:
+            return None, None
+
+        metrics.follow_ups.inc(kind=kind)
+        return session, kind
+
+    def follow_up(self, user_id: str, session: Session, kind: str) -> str:
+        """
+        Answer a follow-up from the user's session, skipping extraction and geocoding.
+
+        The way back is planned with the stored coordinates swapped. Another ranking is picked
+        from the stored candidates, unless there is only one and the preference changed, in
+        which case the route is planned again with the new preference.
+
+        :param user_id: The LINE user ID.
+        :param session: The user's session.
+        :param kind: 'return', 'fare', 'time', or 'transfers'.
+        :return: A JSON-formatted string containing the result.
+        """
+        if kind == "return":
+            return self.replan(user_id, *reverse_session(session))
+
+        route, intent = rank_session(session, kind)
+        if needs_replan(session, intent):
+            return self.replan(user_id, intent, with_preference(session.locations, intent.preference))
+
+        with metrics.timer('render'):
+            itinerary = openai_send_unit.render(route, intent)
+
+        error = check_itinerary(itinerary)
+        if error:
+            return error
+
+        self.sessions.set(user_id, Session(intent, session.locations, route))
+        return itinerary.to_json()
+
+    def replan(self, user_id: str, intent: Intent, locations: Locations) -> str:
+        """Plan and render the route between known locations, and keep it as the user's session"""
+        result, route = self.route_flights.do(get_route_key(locations), self.plan, locations, intent)
+        if route is not None:
+            self.sessions.set(user_id, Session(intent, locations, route))
+        return result
+
+    async def get_result_async(self, input_string: str, user_id: str = None) -> str:
+        """
+        The asyncio version of get_result, which waits on the network without holding a thread.
+
+        :param input_string: The user's input string.
+        :param user_id: The LINE user ID, which enables follow-up questions about the last route.
+        :return: A JSON-formatted string containing the result.
+        """
+        error = check_input(input_string)
+        if error:
+            return error
+
+        if not self.admission.try_acquire():
+            return shed()
+
+        start = time.perf_counter()
+        try:
+            return await self.answer_async(input_string, user_id)
+        finally:
+            self.admission.release(time.perf_counter() - start)
+
+    async def answer_async(self, input_string: str, user_id: str = None) -> str:
+        """The asyncio version of answer"""
+        try:
+            session, kind = self.get_follow_up(input_string, user_id)
+            if session is not None:
+                return await self.follow_up_async(user_id, session, kind)
+
+            result, session = await self.input_flights.do_async(
+                normalize_input(input_string), self.process_async, input_string
+            )
+
+        except RateLimitExceeded:
+            return busy()
+
+        if session is not None and user_id is not None:
+            self.sessions.set(user_id, session)
+        return result
+
+    async def process_async(self, input_string: str) -> tuple:
+        """The asyncio version of process"""
+        with metrics.timer('extract'):
+            intent = await openai_receive_unit.extract_intent_async(input_string)
+
+        error = check_intent(intent)
+        if error:
+            return error, None
+
+        with metrics.timer('geocode'):
+            locations = await map_unit.resolve_async(intent.data)
+
+        error = check_locations(locations)
+        if error:
+            return error, None
+
+        result, route = await self.route_flights.do_async(
+            get_route_key(locations.data), self.plan_async, locations.data, intent.data
+        )
+        return result, Session(intent.data, locations.data, route) if route is not None else None
+
+    async def plan_async(self, locations: Locations, intent: Intent) -> tuple:
+        """The asyncio version of plan"""
+        with metrics.timer('route'):
+            route = await self.tdx_unit.get_route_async(locations)
+
+        error = check_route(route)
+        if error:
+            return error, None
+
+        ranked = route_ranking.rank(route.data, route_ranking.PREFERENCE_ORDERS.get(intent.preference, "time"))
+
+        with metrics.timer('render'):
+            itinerary = await openai_send_unit.render_async(ranked, intent)
+
+        error = check_itinerary(itinerary)
+        if error:
+            return error, None
+
+        return itinerary.to_json(), ranked
+
+    async def follow_up_async(self, user_id: str, session: Session, kind: str) -> str:
+        """The asyncio version of follow_up"""
+        if kind == "return":
+            return await self.replan_async(user_id, *reverse_session(session))
+
+        route, intent = rank_session(session, kind)
+        if needs_replan(session, intent):
+            return await self.replan_async(user_id, intent, with_preference(session.locations, intent.preference))
+
+        with metrics.timer('render'):
+            itinerary = await openai_send_unit.render_async(route, intent)
+
+        error = check_itinerary(itinerary)
+        if error:
+            return error
+
+        self.sessions.set(user_id, Session(intent, session.locations, route))
+        return itinerary.to_json()
+
+    async def replan_async(self, user_id: str, intent: Intent, locations: Locations) -> str:
+        """The asyncio version of replan"""
+        result, route = await self.route_flights.do_async(
+            get_route_key(locations), self.plan_async, locations, intent
+        )
+        if route is not None:
+            self.sessions.set(user_id, Session(intent, locations, route))
+        return result
 
-        return AI_to_USER
+    def stats(self) -> dict:
+        """Return the coalescing statistics of both levels"""
+        return {"input": self.input_flights.stats(), "route": self.route_flights.stats()}
 
 
 # For debugging and testing
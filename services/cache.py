@@ -0,0 +1,317 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+
+def hit_ratio(counters: dict) -> float:
+    """Return the share of lookups that were hits"""
+    total = counters["hits"] + counters["misses"]
+    return counters["hits"] / total if total else 0.0
+
+
+class TTLCache:
+    """
+    A thread-safe in-memory LRU cache whose entries expire after a time-to-live.
+
+    The cache holds at most max_size entries and, when max_bytes is set, at most max_bytes
+    of entry sizes as given to set().
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0, max_bytes: int = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        """
+        Return the cached value of a key, or default if it is missing or expired.
+
+        :param key: The cache key.
+        :param default: The value to return on a miss.
+        :return: The cached value or default.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._counters["misses"] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry[0]
+
+    def set(self, key, value, ttl: float = None, size: int = 0):
+        """
+        Store a value, evicting the least recently used entries when the cache is full.
+
+        :param key: The cache key.
+        :param value: The value to store.
+        :param ttl: The time-to-live in seconds, defaults to the cache's ttl.
+        :param size: The approximate size of the value in bytes, counted against max_bytes.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+
+            while len(self._data) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                self._counters["evictions"] += 1
+
+    def _remove(self, key):
+        # Must be called with the lock held
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def delete(self, key):
+        """Remove a key from the cache"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Return the cache size and hit/miss counters"""
+        with self._lock:
+            stats = {"size": len(self._data), "max_size": self.max_size, **self._counters}
+            stats["hit_ratio"] = hit_ratio(self._counters)
+            if self.max_bytes is not None:
+                stats.update({"bytes": self._bytes, "max_bytes": self.max_bytes})
+            return stats
+
+
+class SqliteStore:
+    """
+    A persistent key-value store backed by a local SQLite file.
+
+    Values are stored as JSON with an absolute expiry time, so they survive restarts and can be
+    shared by several processes on the same host.
+    """
+
+    def __init__(self, path: str, table: str = "cache", max_rows: int = 100000):
+        self.path = path
+        self.table = table
+        self.max_rows = max_rows
+
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._counters = {"hits": 0, "misses": 0}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps the store safe to use from any thread
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key: str, default=None):
+        """
+        Return the stored value of a key, or default if it is missing or expired.
+
+        :param key: The key to look up.
+        :param default: The value to return on a miss.
+        :return: The stored value or default.
+        """
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: str):
+        """
+        Return the stored value of a key together with its expiry time.
+
+        :param key: The key to look up.
+        :return: A (value, expires_at) tuple, or None if the key is missing or expired.
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+
+        with self._lock:
+            self._counters["hits" if row is not None else "misses"] += 1
+
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value, ttl: float):
+        """
+        Store a JSON-serializable value with a time-to-live.
+
+        :param key: The key to store.
+        :param value: The value to store.
+        :param ttl: The time-to-live in seconds.
+        """
+        now = time.time()
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl, now),
+            )
+
+        if self._count_write():
+            self.purge()
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        """
+        Store a value unless the key already holds one that has not expired. The check and the write
+        are one transaction, so only one of several processes adding the same key succeeds.
+
+        :param key: The key to store.
+        :param value: The value to store.
+        :param ttl: The time-to-live in seconds.
+        :return: True if the value was stored, False if the key was taken.
+        """
+        now = time.time()
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute(f"DELETE FROM {self.table} WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = connection.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl, now),
+            )
+
+        if self._count_write():
+            self.purge()
+        return cursor.rowcount == 1
+
+    def _count_write(self) -> bool:
+        """Count a write, returning True on every 100th, when expired and excess rows are purged"""
+        with self._lock:
+            self._writes += 1
+            return self._writes % 100 == 0
+
+    def delete(self, key: str):
+        """Remove a key from the store"""
+        with closing(self._connect()) as connection, connection:
+            connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge(self):
+        """Remove expired rows, then the least recently written rows beyond max_rows"""
+        with closing(self._connect()) as connection, connection:
+            connection.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+            connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
+
+    def stats(self) -> dict:
+        """Return the store size and hit/miss counters"""
+        with closing(self._connect()) as connection:
+            size = connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        with self._lock:
+            counters = dict(self._counters)
+        return {"size": size, "max_rows": self.max_rows, **counters, "hit_ratio": hit_ratio(counters)}
+
+
+class TieredCache:
+    """
+    A two-tier cache: an in-memory TTLCache in front of an optional SqliteStore.
+    """
+
+    def __init__(self, memory: TTLCache, store: SqliteStore = None):
+        self.memory = memory
+        self.store = store
+
+    def get(self, key: str, default=None):
+        """
+        Return the cached value of a key, looking in memory first and then on disk.
+
+        :param key: The cache key.
+        :param default: The value to return on a miss.
+        :return: The cached value or default.
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        if self.store is None:
+            return default
+
+        return self._promote(key, self.store.get_entry(key), default)
+
+    async def get_async(self, key: str, default=None):
+        """
+        The asyncio version of get, which reads the disk in a worker thread so a locked SQLite file
+        does not block the event loop.
+
+        :param key: The cache key.
+        :param default: The value to return on a miss.
+        :return: The cached value or default.
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        if self.store is None:
+            return default
+
+        return self._promote(key, await asyncio.to_thread(self.store.get_entry, key), default)
+
+    def _promote(self, key: str, entry, default):
+        if entry is None:
+            return default
+
+        # Promote the entry to memory for the rest of its lifetime, so the next lookup skips the disk
+        value, expires_at = entry
+        self.memory.set(key, value, expires_at - time.time())
+        return value
+
+    def set(self, key: str, value, ttl: float = None):
+        """
+        Store a value in memory and on disk.
+
+        :param key: The cache key.
+        :param value: The value to store.
+        :param ttl: The time-to-live in seconds, defaults to the memory cache's ttl.
+        """
+        ttl = self.memory.ttl if ttl is None else ttl
+        self.memory.set(key, value, ttl)
+        if self.store is not None:
+            self.store.set(key, value, ttl)
+
+    async def set_async(self, key: str, value, ttl: float = None):
+        """The asyncio version of set, which writes to the disk in a worker thread"""
+        ttl = self.memory.ttl if ttl is None else ttl
+        self.memory.set(key, value, ttl)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.set, key, value, ttl)
+
+    def stats(self) -> dict:
+        """Return the counters of both tiers"""
+        stats = {"memory": self.memory.stats()}
+        if self.store is not None:
+            stats["disk"] = self.store.stats()
+        return stats
@@ -0,0 +1,177 @@
+import threading
+import time
+from dotenv import load_dotenv
+import os
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# A breaker opens after CIRCUIT_FAILURE_THRESHOLD failures in a row, rejects calls for
+# CIRCUIT_RECOVERY_TIME seconds, then lets CIRCUIT_HALF_OPEN_CALLS trial calls through
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RECOVERY_TIME = float(os.getenv("CIRCUIT_RECOVERY_TIME", "30"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Start of the message of CircuitOpenError, so units can report it as a stage failure
+OPEN_MESSAGE = "Circuit breaker is open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open"""
+
+    # Counted under this failure branch by metrics.timer
+    reason = "circuit_open"
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{OPEN_MESSAGE}: {upstream} is unavailable, retrying in {retry_after:.0f} seconds")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def is_open_message(message: str) -> bool:
+    """Check if a failure message comes from an open breaker"""
+    return message.startswith(OPEN_MESSAGE)
+
+
+def is_failure(error: Exception) -> bool:
+    """Check if an error means the upstream is unhealthy, rather than that the request was refused"""
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker of one upstream.
+
+    While closed, calls go through and consecutive failures are counted: transport errors, timeouts
+    and 5xx responses. Once failure_threshold is reached the breaker opens, and calls fail at once
+    with CircuitOpenError for recovery_time seconds. It is then half-open: up to half_open_calls
+    trial calls go through, and the first result closes the breaker again or reopens it.
+    """
+
+    def __init__(self, upstream: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_time: float = CIRCUIT_RECOVERY_TIME, half_open_calls: int = CIRCUIT_HALF_OPEN_CALLS,
+                 enabled: bool = CIRCUIT_BREAKER_ENABLED):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_calls = half_open_calls
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._counters = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self._state == OPEN:
+                remaining = self._opened_at + self.recovery_time - time.monotonic()
+                if remaining > 0:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpenError(self.upstream, remaining)
+                self._state = HALF_OPEN
+                self._trials = 0
+
+            if self._state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpenError(self.upstream, self.recovery_time)
+                self._trials += 1
+
+    def record_success(self):
+        with self._lock:
+            self._counters["successes"] += 1
+            self._failures = 0
+            self._state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._counters["failures"] += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._counters["opened"] += 1
+
+    def record(self, response):
+        """Record the outcome of a call that returned, counting 5xx responses as failures"""
+        if getattr(response, "status_code", 200) >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call an upstream through the breaker.
+
+        :param func: The function sending the request.
+        :return: The result of func.
+        """
+        self.allow()
+        try:
+            response = func(*args, **kwargs)
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record(response)
+        return response
+
+    async def call_async(self, func, *args, **kwargs):
+        """The asyncio version of call, for coroutine functions"""
+        self.allow()
+        try:
+            response = await func(*args, **kwargs)
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record(response)
+        return response
+
+    def state(self) -> str:
+        """Return the current state, reporting an open breaker whose recovery time has passed as half-open"""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() >= self._opened_at + self.recovery_time:
+                return HALF_OPEN
+            return self._state
+
+    def stats(self) -> dict:
+        state = self.state()
+        with self._lock:
+            return {
+                "state": state,
+                "open": state != CLOSED,
+                "consecutive_failures": self._failures,
+                **self._counters,
+            }
+
+
+# One breaker per upstream, shared by every thread and task of the process
+breakers = {upstream: CircuitBreaker(upstream) for upstream in ("openai", "geocode", "tdx")}
+
+
+def stats() -> dict:
+    """Return the state and counters of every breaker"""
+    return {upstream: breaker.stats() for upstream, breaker in breakers.items()}
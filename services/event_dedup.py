@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from dotenv import load_dotenv
+import os
+from services.cache import TTLCache, SqliteStore
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Webhook event IDs are remembered for WEBHOOK_DEDUP_TTL seconds, at most WEBHOOK_DEDUP_SIZE of them in
+# memory, or in a SQLite file shared by every worker process when WEBHOOK_DEDUP_PATH is set
+WEBHOOK_DEDUP_ENABLED = os.getenv("WEBHOOK_DEDUP_ENABLED", "true").lower() == "true"
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", str(24 * 60 * 60)))
+WEBHOOK_DEDUP_PATH = os.getenv("WEBHOOK_DEDUP_PATH", "")
+
+
+class EventDeduplicator:
+    """
+    Drop webhook events that were already received, such as the redeliveries LINE sends when our
+    reply is slow.
+
+    The first delivery of an event claims its webhookEventId, and later deliveries of the same ID
+    are suppressed while the first one is handled or after it has replied. A claim is released when
+    handling the event fails, so a redelivery can retry it.
+    """
+
+    def __init__(self, max_size: int = WEBHOOK_DEDUP_SIZE, ttl: float = WEBHOOK_DEDUP_TTL,
+                 path: str = WEBHOOK_DEDUP_PATH):
+        """
+        :param max_size: The number of event IDs kept in memory.
+        :param ttl: The number of seconds an event ID is remembered.
+        :param path: The SQLite file shared by worker processes, or an empty string to keep the IDs in memory.
+        """
+        self.ttl = ttl
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self.store = SqliteStore(path, table="webhook_events", max_rows=max_size) if path else None
+
+        self._lock = threading.Lock()
+        self._counters = {"claimed": 0, "suppressed": 0, "suppressed_redeliveries": 0, "released": 0}
+
+    def claim(self, event_id: str) -> bool:
+        """
+        Record an event ID.
+
+        :param event_id: The webhookEventId of the event.
+        :return: True if the ID is new, False if it was already claimed by this or another process.
+        """
+        if self.store is not None:
+            return self.store.add(event_id, True, self.ttl)
+
+        with self._lock:
+            if self.memory.get(event_id) is not None:
+                return False
+            self.memory.set(event_id, True)
+            return True
+
+    def release(self, event):
+        """Forget the ID of an event that could not be handled, so its redelivery is handled again"""
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return
+
+        if self.store is not None:
+            self.store.delete(event_id)
+        else:
+            self.memory.delete(event_id)
+        self._count("released")
+
+    def filter(self, events: list) -> list:
+        """
+        Claim the events of a delivery and drop the ones already received.
+
+        :param events: The parsed webhook events.
+        :return: The events to handle, in order. Events without an ID are always kept.
+        """
+        fresh = []
+        for event in events:
+            event_id = getattr(event, "webhook_event_id", None)
+            if not event_id or self.claim(event_id):
+                if event_id:
+                    self._count("claimed")
+                fresh.append(event)
+                continue
+
+            self._count("suppressed")
+            if getattr(getattr(event, "delivery_context", None), "is_redelivery", False):
+                self._count("suppressed_redeliveries")
+        return fresh
+
+    async def filter_async(self, events: list) -> list:
+        """The asyncio version of filter, which claims the IDs in a worker thread when they are kept in SQLite"""
+        if self.store is None:
+            return self.filter(events)
+        return await asyncio.to_thread(self.filter, events)
+
+    async def release_async(self, event):
+        """The asyncio version of release, which forgets the ID in a worker thread when it is kept in SQLite"""
+        if self.store is None:
+            self.release(event)
+        else:
+            await asyncio.to_thread(self.release, event)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> dict:
+        """Return the claim counters and the size of the ID store"""
+        with self._lock:
+            counters = dict(self._counters)
+        store = self.store.stats() if self.store is not None else self.memory.stats()
+        return {**counters, "size": store["size"]}
@@ -0,0 +1,323 @@
+"""
+A local index of Taiwan transit stations and landmarks, for geocoding well-known places without Google.
+
+Rebuild the bundled data from the TDX station APIs (landmark rows are kept):
+    python -m services.gazetteer rebuild --bus-city Taipei --bus-city NewTaipei
+"""
+import argparse
+import bisect
+import csv
+import os
+import threading
+import unicodedata
+from array import array
+
+# Generic words removed before names are compared, so "捷運市政府站" and "市政府" share a key
+STRIP_PREFIXES = ("捷運", "台鐵", "火車")
+STRIP_SUFFIXES = ("捷運站",)
+
+# A prefix matches when all of the first keys starting with it belong to one place
+PREFIX_MATCH_LIMIT = 8
+
+# Place names are wrapped like "台北車站(台灣)" before they are sent to Google
+QUALIFIERS = ("(台灣)", "(臺灣)")
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize a place name into an index key: width, case, spacing, punctuation, 臺/台,
+    and generic transit prefixes are ignored.
+
+    :param name: The place name.
+    :return: The index key.
+    """
+    name = unicodedata.normalize("NFKC", name)
+    for qualifier in QUALIFIERS:
+        name = name.replace(qualifier, "")
+    name = "".join(
+        char for char in name.lower()
+        if not char.isspace() and not unicodedata.category(char).startswith("P")
+    ).replace("臺", "台")
+
+    for prefix in STRIP_PREFIXES:
+        if name.startswith(prefix) and len(name) > len(prefix) + 1:
+            name = name[len(prefix):]
+    for suffix in STRIP_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix) + 1:
+            name = name[:-len(suffix)]
+    return name
+
+
+def ngrams(key: str) -> set:
+    """Return the bigrams and trigrams of a key, or the key itself if it is shorter than two characters"""
+    if len(key) < 2:
+        return {key}
+    grams = {key[index:index + 2] for index in range(len(key) - 1)}
+    grams.update(key[index:index + 3] for index in range(len(key) - 2))
+    return grams
+
+
+class Gazetteer:
+    """
+    An in-memory index of place names and their coordinates.
+
+    Coordinates are kept in flat arrays, and every name and alias is a key pointing at its place.
+    A key is found by an exact match, by being the only key starting with the query, or by the
+    n-gram similarity of the query and the key.
+    """
+
+    def __init__(self, min_score: float = 0.75):
+        """
+        :param min_score: The lowest Dice similarity of n-grams accepted for a fuzzy match.
+        """
+        self.min_score = min_score
+
+        # One item per place
+        self.names = []
+        self.lats = array("d")
+        self.lngs = array("d")
+
+        # One item per key, a key being a normalized name or alias
+        self.keys = []
+        self.key_places = array("I")
+        self.key_sizes = array("H")
+        self._key_ids = {}
+        self._sorted_keys = []
+        self._sorted = True
+        self._grams = {}
+
+        self._lock = threading.Lock()
+        self._counters = {"exact": 0, "prefix": 0, "fuzzy": 0, "misses": 0}
+
+    def add(self, name: str, lat: float, lng: float, aliases: list = ()):
+        """
+        Add a place. Keys already taken by an earlier place are skipped.
+
+        :param name: The display name of the place.
+        :param lat: The latitude.
+        :param lng: The longitude.
+        :param aliases: Other names of the place.
+        """
+        place = len(self.names)
+        self.names.append(name)
+        self.lats.append(lat)
+        self.lngs.append(lng)
+
+        for alias in [name, *aliases]:
+            key = normalize_name(alias)
+            if not key or key in self._key_ids:
+                continue
+
+            key_id = len(self.keys)
+            grams = ngrams(key)
+            self.keys.append(key)
+            self.key_places.append(place)
+            self.key_sizes.append(len(grams))
+            self._key_ids[key] = key_id
+            self._sorted_keys.append(key)
+            self._sorted = False
+            for gram in grams:
+                self._grams.setdefault(gram, array("I")).append(key_id)
+
+    @classmethod
+    def load(cls, path: str, min_score: float = 0.75) -> "Gazetteer":
+        """
+        Load a gazetteer from a TSV file with name, lat, lng, category and aliases columns.
+
+        :param path: The path of the file.
+        :param min_score: The lowest similarity accepted for a fuzzy match.
+        :return: The gazetteer, empty if the file does not exist.
+        """
+        gazetteer = cls(min_score)
+        for row in read_rows(path):
+            aliases = [alias for alias in row["aliases"].split(",") if alias]
+            gazetteer.add(row["name"], float(row["lat"]), float(row["lng"]), aliases)
+        return gazetteer
+
+    def _find(self, key: str):
+        # Return the (key ID, kind) of the best match of a normalized name, or (None, None)
+        key_id = self._key_ids.get(key)
+        if key_id is not None:
+            return key_id, "exact"
+
+        # A query that only the keys of one place start with, such as "南港展覽" for "南港展覽館"
+        if len(key) >= 3:
+            if not self._sorted:
+                # Swap in a sorted copy, so concurrent lookups never see a half-sorted list
+                self._sorted_keys = sorted(self._sorted_keys)
+                self._sorted = True
+            start = bisect.bisect_left(self._sorted_keys, key)
+            matches = [
+                self._key_ids[match] for match in self._sorted_keys[start:start + PREFIX_MATCH_LIMIT]
+                if match.startswith(key)
+            ]
+            if matches and len({self.key_places[match] for match in matches}) == 1:
+                return matches[0], "prefix"
+
+        # The key sharing the most n-grams relative to both sizes (Dice similarity)
+        grams = ngrams(key)
+        shared = {}
+        for gram in grams:
+            for candidate in self._grams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        best_id, best_score = None, 0.0
+        for candidate, count in shared.items():
+            score = 2 * count / (len(grams) + self.key_sizes[candidate])
+            if score > best_score:
+                best_id, best_score = candidate, score
+
+        if best_id is not None and best_score >= self.min_score:
+            return best_id, "fuzzy"
+        return None, None
+
+    def lookup(self, name: str):
+        """
+        Resolve a place name to coordinates.
+
+        :param name: The place name.
+        :return: A dictionary containing latitude and longitude, or None if the place is unknown.
+        """
+        key_id, kind = self._find(normalize_name(name))
+
+        with self._lock:
+            self._counters[kind or "misses"] += 1
+
+        if key_id is None:
+            return None
+        place = self.key_places[key_id]
+        return {"lat": self.lats[place], "lng": self.lngs[place]}
+
+    def match(self, name: str):
+        """Return the display name of the place a name resolves to, or None"""
+        key_id, _ = self._find(normalize_name(name))
+        return None if key_id is None else self.names[self.key_places[key_id]]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def stats(self) -> dict:
+        """Return the number of places and keys, and the lookup counters"""
+        with self._lock:
+            lookups = sum(self._counters.values())
+            hits = lookups - self._counters["misses"]
+            return {
+                "places": len(self.names),
+                "keys": len(self.keys),
+                **self._counters,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+            }
+
+
+FIELDS = ["name", "lat", "lng", "category", "aliases"]
+
+
+def read_rows(path: str) -> list:
+    """Read the rows of a gazetteer TSV file, or return no rows if it does not exist"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8", newline="") as file:
+        return list(csv.DictReader(file, delimiter="\t"))
+
+
+def write_rows(path: str, rows: list):
+    """Write the rows of a gazetteer TSV file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def station_row(station: dict, category: str, name: str, aliases: list) -> dict:
+    """Build a gazetteer row from a TDX station record"""
+    position = station["StationPosition"]
+    return {
+        "name": name,
+        "lat": f"{position['PositionLat']:.6f}",
+        "lng": f"{position['PositionLon']:.6f}",
+        "category": category,
+        "aliases": ",".join(alias for alias in aliases if alias != name),
+    }
+
+
+def fetch_stations(bus_cities: list) -> list:
+    """
+    Fetch the MRT, TRA and THSR stations, and the bus stations of some cities, from TDX.
+
+    :param bus_cities: TDX city names, such as 'Taipei', whose bus stations are included.
+    :return: A list of gazetteer rows.
+    """
+    import services.http_client as http_client
+    import services.tdx_unit as tdx_unit
+
+    unit = tdx_unit.TdxUnit()
+    headers = unit.get_data_header(unit.get_access_token())
+
+    def fetch(path: str):
+        response = http_client.get(f"{tdx_unit.basic_url}{path}", params={"$format": "JSON"}, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    rows = []
+
+    for station in fetch("/v3/Rail/TRA/Station")["Stations"]:
+        name = station["StationName"]["Zh_tw"]
+        rows.append(station_row(station, "tra", f"{name}車站", [f"{name}火車站", f"台鐵{name}站"]))
+
+    for station in fetch("/v2/Rail/THSR/Station"):
+        name = station["StationName"]["Zh_tw"]
+        rows.append(station_row(station, "thsr", f"高鐵{name}站", [f"高鐵{name}", f"{name}高鐵站"]))
+
+    for operator in ("TRTC", "NTMC", "NTALRT", "TYMC", "TMRT", "KRTC", "KLRT"):
+        for station in fetch(f"/v2/Rail/Metro/Station/{operator}"):
+            name = station["StationName"]["Zh_tw"]
+            rows.append(station_row(station, "mrt", name, [f"{name}站", f"捷運{name}站"]))
+
+    for city in bus_cities:
+        for station in fetch(f"/v2/Bus/Station/City/{city}"):
+            name = station["StationName"]["Zh_tw"]
+            rows.append(station_row(station, "bus", name, []))
+
+    return rows
+
+
+def rebuild(path: str, bus_cities: list) -> int:
+    """
+    Replace the station rows of a gazetteer file with fresh TDX data, keeping its landmark rows.
+
+    :param path: The path of the file.
+    :param bus_cities: TDX city names whose bus stations are included.
+    :return: The number of rows written.
+    """
+    landmarks = [row for row in read_rows(path) if row["category"] == "landmark"]
+
+    # Stations served by several lines or operators, or named like another place's alias, are listed once
+    rows, seen = [], set()
+    for row in fetch_stations(bus_cities) + landmarks:
+        if normalize_name(row["name"]) in seen:
+            continue
+        rows.append(row)
+        seen.update(normalize_name(alias) for alias in [row["name"], *row["aliases"].split(",")] if alias)
+
+    write_rows(path, rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    import services.map_unit as map_unit
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="fetch the stations from TDX")
+    rebuild_parser.add_argument("--output", default=map_unit.GAZETTEER_PATH, help="the gazetteer file to write")
+    rebuild_parser.add_argument("--bus-city", action="append", default=[], help="include the bus stations of a city")
+    lookup_parser = subparsers.add_parser("lookup", help="resolve place names with the gazetteer")
+    lookup_parser.add_argument("names", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(f"Wrote {rebuild(args.output, args.bus_city)} places to {args.output}")
+    else:
+        for place in args.names:
+            print(place, map_unit.gazetteer.match(place), map_unit.gazetteer.lookup(place))
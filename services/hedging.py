@@ -0,0 +1,218 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+import os
+import services.http_client as http_client
+import services.rate_limiter as rate_limiter
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Hedged GETs: once a request takes longer than the HEDGE_PERCENTILE of the last HEDGE_WINDOW latencies
+# of its upstream (and at least HEDGE_MIN_DELAY seconds), an identical request is sent and the first
+# response wins. Nothing is hedged until HEDGE_MIN_SAMPLES latencies were seen.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+# Threads of the primary request pool and of the hedge pool each
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+
+
+class LatencyWindow:
+    """The recent latencies of one upstream, and the hedging counters"""
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=size)
+        self._counters = {"requests": 0, "hedged": 0, "hedge_wins": 0}
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        """
+        Return how long to wait before hedging a request.
+
+        :return: The delay in seconds, or None if too few latencies were seen.
+        """
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(HEDGE_PERCENTILE * len(ordered)))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+    def count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        with self._lock:
+            return {"samples": len(self._latencies), "delay": delay or 0.0, **self._counters}
+
+
+_lock = threading.Lock()
+_windows = {}
+_executors = {}
+
+# Primary requests and hedges run on separate pools. A request never waits in a pool's queue: without a
+# free thread, the primary is sent from the calling thread and the hedge is skipped
+_slots = {pool: threading.BoundedSemaphore(HEDGE_WORKERS) for pool in ("primary", "hedge")}
+
+
+def get_window(upstream: str) -> LatencyWindow:
+    """Return the latency window of an upstream, creating it on first use"""
+    with _lock:
+        if upstream not in _windows:
+            _windows[upstream] = LatencyWindow()
+        return _windows[upstream]
+
+
+def get_executor(pool: str) -> ThreadPoolExecutor:
+    """Return the thread pool running the primary requests or the hedges, creating it on first use"""
+    with _lock:
+        if pool not in _executors:
+            _executors[pool] = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix=f"hedge-{pool}")
+        return _executors[pool]
+
+
+def submit(pool: str, func, *args, **kwargs):
+    """
+    Run a function on a free thread of a pool.
+
+    :param pool: 'primary' or 'hedge'.
+    :param func: The function to run.
+    :return: The Future of the call, or None if every thread of the pool is busy.
+    """
+    if not _slots[pool].acquire(blocking=False):
+        return None
+
+    future = get_executor(pool).submit(contextvars.copy_context().run, func, *args, **kwargs)
+    future.add_done_callback(lambda _: _slots[pool].release())
+    return future
+
+
+def timed_get(window: LatencyWindow, url: str, **kwargs):
+    """Send a GET and record its latency from the moment it is sent"""
+    start = time.perf_counter()
+    response = http_client.get(url, **kwargs)
+    window.add(time.perf_counter() - start)
+    return response
+
+
+def get(upstream: str, url: str, api_key: str = "", **kwargs):
+    """
+    Send an idempotent GET, hedging it with a second request when it is slower than usual.
+
+    The hedge is skipped when the upstream's rate limiter has no token to spare, or when every
+    thread of the hedge pool is busy.
+
+    :param upstream: 'geocode' or 'tdx', whose latencies set the hedging delay.
+    :param url: The URL to request.
+    :param api_key: The API key of the request, whose rate limiter the hedge is taken from.
+    :return: The first response, or the first error if both requests fail.
+    """
+    window = get_window(upstream)
+    window.count("requests")
+    delay = window.delay() if HEDGE_ENABLED else None
+
+    primary = submit("primary", timed_get, window, url, **kwargs) if delay is not None else None
+    if primary is None:
+        return timed_get(window, url, **kwargs)
+
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = None
+    if rate_limiter.try_acquire(upstream, api_key):
+        hedge = submit("hedge", timed_get, window, url, **kwargs)
+    if hedge is None:
+        return primary.result()
+
+    window.count("hedged")
+
+    # Return the first response; the slower request finishes in the background
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    window.count("hedge_wins")
+                return future.result()
+
+    raise primary.exception()
+
+
+async def timed_get_async(window: LatencyWindow, url: str, **kwargs):
+    """The asyncio version of timed_get"""
+    start = time.perf_counter()
+    response = await http_client.get_async(url, **kwargs)
+    window.add(time.perf_counter() - start)
+    return response
+
+
+async def get_async(upstream: str, url: str, api_key: str = "", **kwargs):
+    """
+    The asyncio version of get, which cancels the slower request.
+
+    :param upstream: 'geocode' or 'tdx', whose latencies set the hedging delay.
+    :param url: The URL to request.
+    :param api_key: The API key of the request, whose rate limiter the hedge is taken from.
+    :return: The first response, or the first error if both requests fail.
+    """
+    window = get_window(upstream)
+    window.count("requests")
+    delay = window.delay() if HEDGE_ENABLED else None
+
+    if delay is None:
+        return await timed_get_async(window, url, **kwargs)
+
+    primary = asyncio.ensure_future(timed_get_async(window, url, **kwargs))
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait([primary], timeout=delay)
+
+        if done or not rate_limiter.try_acquire(upstream, api_key):
+            return await primary
+
+        window.count("hedged")
+        hedge = asyncio.ensure_future(timed_get_async(window, url, **kwargs))
+        tasks.append(hedge)
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        window.count("hedge_wins")
+                    return task.result()
+
+        raise primary.exception()
+
+    finally:
+        # Stop the slower request, or both if the caller was cancelled
+        for task in tasks:
+            task.cancel()
+
+
+def stats() -> dict:
+    """Return the hedging delay and counters of every upstream"""
+    with _lock:
+        windows = dict(_windows)
+    return {upstream: window.stats() for upstream, window in windows.items()}
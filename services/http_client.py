@@ -0,0 +1,218 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+import os
+import services.metrics as metrics
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Timeouts (in seconds) applied to every request that does not set its own
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+
+# Retries with exponential backoff, only for idempotent GET requests. A Retry-After header is honoured
+# for at most HTTP_MAX_RETRY_WAIT seconds, so a worker is never parked for as long as the upstream asks
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.3"))
+HTTP_MAX_RETRY_WAIT = float(os.getenv("HTTP_MAX_RETRY_WAIT", "2"))
+
+# Status codes of GET requests that are retried. HTTP 429 is not one of them: it is returned to the
+# service unit, which pauses its rate limiter for the Retry-After instead
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# Number of keep-alive connections kept per host, e.g. "tdx.transportdata.tw=20,maps.googleapis.com=10"
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_POOL_SIZES = os.getenv("HTTP_POOL_SIZES", "")
+
+
+def parse_pool_sizes(value: str) -> dict:
+    """
+    Parse the per-host pool sizes setting.
+
+    :param value: A comma-separated list of host=size pairs.
+    :return: A dictionary mapping host names to pool sizes.
+    """
+    pool_sizes = {}
+    for item in value.split(","):
+        if "=" in item:
+            host, size = item.split("=", 1)
+            pool_sizes[host.strip()] = int(size)
+    return pool_sizes
+
+
+class CappedRetry(Retry):
+    """
+    A Retry whose wait for a Retry-After header is capped at HTTP_MAX_RETRY_WAIT seconds, and which
+    leaves HTTP 429 to the rate limiter even when the response has a Retry-After header.
+    """
+
+    RETRY_AFTER_STATUS_CODES = frozenset([503])
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, HTTP_MAX_RETRY_WAIT)
+
+
+def create_session() -> requests.Session:
+    """
+    Create a session with pooled keep-alive connections and retries for GET requests.
+
+    :return: The configured session.
+    """
+    retry = CappedRetry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        backoff_max=HTTP_MAX_RETRY_WAIT,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry))
+    session.mount("http://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry))
+
+    for host, size in parse_pool_sizes(HTTP_POOL_SIZES).items():
+        session.mount(f"https://{host}/", HTTPAdapter(pool_maxsize=size, max_retries=retry))
+
+    return session
+
+
+# Shared by all service units, so connections to the same host are reused across requests
+session = create_session()
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request through the shared session, applying the default timeouts.
+
+    :param method: The HTTP method.
+    :param url: The request URL.
+    :return: The response.
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+    host = urlsplit(url).hostname
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        metrics.http_errors.inc(host=host, method=method, error=type(e).__name__)
+        raise
+    finally:
+        metrics.http_duration.observe(time.perf_counter() - start, host=host, method=method)
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Send a GET request through the shared session"""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Send a POST request through the shared session"""
+    return request("POST", url, **kwargs)
+
+
+_async_client = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Return the shared asyncio client, creating it on first use. It must only be used from one event loop.
+
+    :return: The asyncio client with pooled keep-alive connections.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_keepalive_connections=HTTP_POOL_SIZE),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """Close the shared asyncio client, so the event loop can shut down cleanly"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def request_async(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Send a request through the shared asyncio client, retrying GET requests like the session does.
+
+    :param method: The HTTP method.
+    :param url: The request URL.
+    :return: The response.
+    """
+    host = urlsplit(url).hostname
+    retries = HTTP_RETRIES if method == "GET" else 0
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = await get_async_client().request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            metrics.http_errors.inc(host=host, method=method, error=type(e).__name__)
+            if attempt == retries or not isinstance(e, httpx.TransportError):
+                raise
+            response = None
+        finally:
+            metrics.http_duration.observe(time.perf_counter() - start, host=host, method=method)
+
+        if response is not None and (response.status_code not in RETRY_STATUSES or attempt == retries):
+            return response
+
+        # Honour Retry-After when the upstream sends one, otherwise back off exponentially
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        delay = float(retry_after) if retry_after.isdigit() else HTTP_BACKOFF_FACTOR * (2 ** attempt)
+        await asyncio.sleep(min(delay, HTTP_MAX_RETRY_WAIT))
+
+
+async def get_async(url: str, **kwargs) -> httpx.Response:
+    """Send a GET request through the shared asyncio client"""
+    return await request_async("GET", url, **kwargs)
+
+
+async def post_async(url: str, **kwargs) -> httpx.Response:
+    """Send a POST request through the shared asyncio client"""
+    return await request_async("POST", url, **kwargs)
+
+
+def stats() -> dict:
+    """
+    Report connection reuse per host.
+
+    :return: A dictionary mapping host names to the number of requests, opened connections and reused connections.
+    """
+    hosts = {}
+
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = hosts.setdefault(pool.host, {"requests": 0, "connections": 0})
+            host["requests"] += pool.num_requests
+            host["connections"] += pool.num_connections
+
+    for host in hosts.values():
+        host["reused"] = max(host["requests"] - host["connections"], 0)
+
+    return hosts
@@ -1,8 +1,17 @@
+import asyncio
 import json
-import requests
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+import services.hedging as hedging
 from dotenv import load_dotenv
 import os
-import re
+import unicodedata
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from services.cache import TTLCache, SqliteStore, TieredCache
+from services.gazetteer import Gazetteer
+from services.pipeline import StageResult, Intent, Locations
+from services.rate_limiter import RateLimitExceeded
 
 # Load the .env file
 parent_dir = os.path.abspath(
@@ -14,6 +23,25 @@ load_dotenv(dotenv_path=env_path)
 
 GOOGLE_MAP_API_KEY= os.getenv("GOOGLE_MAP_API_KEY")
 
+# Endpoint of the Geocoding API, which can point to a local stand-in for benchmarks
+GOOGLE_GEOCODE_URL = os.getenv("GOOGLE_GEOCODE_URL", "https://maps.googleapis.com/maps/api/geocode/json")
+
+# Timeout (in seconds) for resolving both the origin and the destination
+GEOCODE_TIMEOUT = float(os.getenv("GEOCODE_TIMEOUT", "10"))
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", "8"))
+
+# Geocode cache: resolved places are kept for GEOCODE_CACHE_TTL seconds, unknown places for GEOCODE_NEGATIVE_TTL
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "1024"))
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 60 * 60)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", str(60 * 60)))
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", os.path.join(parent_dir, "geocode_cache.sqlite3"))
+GEOCODE_CACHE_DISK_ROWS = int(os.getenv("GEOCODE_CACHE_DISK_ROWS", "100000"))
+
+# Stations and landmarks in the local gazetteer are resolved without calling Google
+GAZETTEER_ENABLED = os.getenv("GAZETTEER_ENABLED", "true").lower() == "true"
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(parent_dir, "data", "gazetteer.tsv"))
+GAZETTEER_MIN_SCORE = float(os.getenv("GAZETTEER_MIN_SCORE", "0.75"))
+
 # Simulating a configuration file to hold the API key
 config = {
     "API_KEY": {
@@ -21,31 +49,228 @@ config = {
     }
 }
 
+# Shared thread pool, so the origin and destination are geocoded at the same time
+executor = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS, thread_name_prefix="geocode")
 
-def get_geocode(location: str, api_key: str) -> dict:
+# Two-tier geocode cache, the on-disk store is disabled when GEOCODE_CACHE_PATH is empty
+geocode_cache = TieredCache(
+    TTLCache(max_size=GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL),
+    SqliteStore(GEOCODE_CACHE_PATH, table="geocode", max_rows=GEOCODE_CACHE_DISK_ROWS) if GEOCODE_CACHE_PATH else None,
+)
+
+
+gazetteer = Gazetteer.load(GAZETTEER_PATH, GAZETTEER_MIN_SCORE) if GAZETTEER_ENABLED else Gazetteer()
+
+
+def normalize_location(location: str) -> str:
     """
-    Fetch the geocode (latitude and longitude) for a given location using the Google Maps Geocoding API.
+    Normalize a location name into a cache key, so that width and spacing variants share an entry.
 
-    :param location: The name of the location to geocode.
-    :param api_key: The API key for accessing Google Maps Geocoding API.
+    :param location: The name of the location.
+    :return: The normalized name.
+    """
+    location = unicodedata.normalize("NFKC", location)
+    return "".join(location.split()).lower()
+
+
+def read_entry(entry: dict) -> dict:
+    """
+    Read the coordinates of a geocode result.
+
+    :param entry: The status of the lookup, with the latitude and longitude if it is "OK".
     :return: A dictionary containing latitude and longitude.
     """
-    base_url = "https://maps.googleapis.com/maps/api/geocode/json"
-    url = f"{base_url}?address={location}&key={api_key}"
+    if entry["status"] != "OK":
+        raise Exception(f"Failed to get geocode: {entry['status']}")
+    return {"lat": entry["lat"], "lng": entry["lng"]}
+
+
+def get_cached_geocode(cache_key: str):
+    """
+    Look up a location in the geocode cache.
+
+    :param cache_key: The normalized name of the location.
+    :return: A dictionary containing latitude and longitude, or None if the location is not cached.
+    """
+    cached = geocode_cache.get(cache_key)
+    return None if cached is None else read_entry(cached)
+
+
+async def get_cached_geocode_async(cache_key: str):
+    """The asyncio version of get_cached_geocode, which reads the on-disk cache in a worker thread"""
+    cached = await geocode_cache.get_async(cache_key)
+    return None if cached is None else read_entry(cached)
+
+
+def get_cache_ttl(entry: dict):
+    """
+    Return how long a geocode result is cached.
+
+    :param entry: The geocode result returned by parse_response.
+    :return: The time-to-live in seconds, None for the cache's default, or 0 if the result is not cached.
+    """
+    if entry["status"] == "OK":
+        return None
+    return GEOCODE_NEGATIVE_TTL if entry["status"] == "ZERO_RESULTS" else 0
+
+
+def get_url(location: str, api_key: str) -> str:
+    """Generate the Geocoding API URL of a location"""
+    base_url = GOOGLE_GEOCODE_URL
+    return f"{base_url}?address={location}&key={api_key}"
 
-    response = requests.get(url)
+
+def parse_response(response, api_key: str) -> dict:
+    """
+    Parse a Geocoding API response.
+
+    :param response: The response of the requests session or of the asyncio client.
+    :param api_key: The API key the request was sent with, whose rate limiter is told about HTTP 429.
+    :return: The status of the lookup, with the latitude and longitude if it is "OK".
+    """
+    if response.status_code == 429:
+        raise rate_limiter.throttled("geocode", api_key, rate_limiter.parse_retry_after(response.headers))
 
     if response.status_code == 200:
         data = response.json()
+        if data["status"] == "OVER_QUERY_LIMIT":
+            raise rate_limiter.throttled("geocode", api_key)
         if data["status"] == "OK":
             location = data["results"][0]["geometry"]["location"]
-            return {"lat": location["lat"], "lng": location["lng"]}
-        else:
-            raise Exception(f"Failed to get geocode: {data['status']}")
+            return {"status": "OK", "lat": location["lat"], "lng": location["lng"]}
+        return {"status": data["status"]}
     else:
         raise Exception(f"Failed to fetch data from API: {response.status_code}")
 
 
+def get_geocode(location: str, api_key: str) -> dict:
+    """
+    Fetch the geocode (latitude and longitude) for a given location using the Google Maps Geocoding API.
+
+    :param location: The name of the location to geocode.
+    :param api_key: The API key for accessing Google Maps Geocoding API.
+    :return: A dictionary containing latitude and longitude.
+    """
+    cache_key = normalize_location(location)
+
+    cached = get_cached_geocode(cache_key)
+    if cached is not None:
+        return cached
+
+    rate_limiter.acquire("geocode", api_key)
+    response = circuit_breaker.breakers["geocode"].call(hedging.get, "geocode", get_url(location, api_key), api_key)
+    entry = parse_response(response, api_key)
+
+    ttl = get_cache_ttl(entry)
+    if ttl != 0:
+        geocode_cache.set(cache_key, entry, ttl)
+    return read_entry(entry)
+
+
+async def get_geocode_async(location: str, api_key: str) -> dict:
+    """
+    The asyncio version of get_geocode.
+
+    :param location: The name of the location to geocode.
+    :param api_key: The API key for accessing Google Maps Geocoding API.
+    :return: A dictionary containing latitude and longitude.
+    """
+    cache_key = normalize_location(location)
+
+    cached = await get_cached_geocode_async(cache_key)
+    if cached is not None:
+        return cached
+
+    await rate_limiter.acquire_async("geocode", api_key)
+    response = await circuit_breaker.breakers["geocode"].call_async(
+        hedging.get_async, "geocode", get_url(location, api_key), api_key
+    )
+    entry = parse_response(response, api_key)
+
+    ttl = get_cache_ttl(entry)
+    if ttl != 0:
+        await geocode_cache.set_async(cache_key, entry, ttl)
+    return read_entry(entry)
+
+
+def merge_results(results: list, fetched: list) -> list:
+    """Fill the places the gazetteer did not know with the geocodes fetched for them, in order"""
+    fetched = iter(fetched)
+    return [result if result is not None else next(fetched) for result in results]
+
+
+def get_geocodes(locations: list, api_key: str, timeout: float = GEOCODE_TIMEOUT) -> list:
+    """
+    Fetch the geocodes of several locations concurrently.
+
+    If any lookup fails or the timeout is exceeded, the remaining lookups are cancelled and
+    the error is raised.
+
+    :param locations: The names of the locations to geocode.
+    :param api_key: The API key for accessing Google Maps Geocoding API.
+    :param timeout: The maximum time in seconds to wait for all lookups.
+    :return: A list of dictionaries containing latitude and longitude, in the same order as locations.
+    """
+    # Resolve the places known to the gazetteer locally, and only send the others to Google
+    results = [gazetteer.lookup(location) for location in locations]
+    remaining = [location for location, result in zip(locations, results) if result is None]
+    if not remaining:
+        return results
+
+    # Run each lookup in a copy of the caller's context, so it keeps the request's trace ID
+    futures = [
+        executor.submit(contextvars.copy_context().run, get_geocode, location, api_key)
+        for location in remaining
+    ]
+
+    done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+
+    for future in not_done:
+        future.cancel()
+
+    # Raise the first error in the input order, so the message is deterministic
+    for future in futures:
+        if future in done and future.exception() is not None:
+            raise future.exception()
+
+    if not_done:
+        raise Exception(f"Failed to get geocode: timed out after {timeout} seconds")
+
+    return merge_results(results, [future.result() for future in futures])
+
+
+async def get_geocodes_async(locations: list, api_key: str, timeout: float = GEOCODE_TIMEOUT) -> list:
+    """
+    The asyncio version of get_geocodes, running the lookups as tasks instead of on the thread pool.
+
+    :param locations: The names of the locations to geocode.
+    :param api_key: The API key for accessing Google Maps Geocoding API.
+    :param timeout: The maximum time in seconds to wait for all lookups.
+    :return: A list of dictionaries containing latitude and longitude, in the same order as locations.
+    """
+    results = [gazetteer.lookup(location) for location in locations]
+    remaining = [location for location, result in zip(locations, results) if result is None]
+    if not remaining:
+        return results
+
+    tasks = [asyncio.ensure_future(get_geocode_async(location, api_key)) for location in remaining]
+
+    done, not_done = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+
+    for task in not_done:
+        task.cancel()
+
+    # Raise the first error in the input order, so the message is deterministic
+    for task in tasks:
+        if task in done and task.exception() is not None:
+            raise task.exception()
+
+    if not_done:
+        raise Exception(f"Failed to get geocode: timed out after {timeout} seconds")
+
+    return merge_results(results, [task.result() for task in tasks])
+
+
 def process_text(preference: str) -> int:
     """
     Convert user preference text into a numerical code.
@@ -65,55 +290,90 @@ def process_text(preference: str) -> int:
         return 1
 
 
-def get_result(input_string: str) -> str:
+def build_locations(origin: dict, destination: dict, preference: str) -> Locations:
+    """Combine the geocodes of the origin and destination with the converted preference"""
+    return Locations(
+        [origin["lng"], origin["lat"]],
+        [destination["lng"], destination["lat"]],
+        process_text(preference),
+    )
+
+
+def resolve(intent: Intent) -> StageResult:
     """
-    Process user input, fetch geocode data, and generate a result in JSON format.
+    Fetch the geocodes of the origin and destination and convert the preference.
 
-    :param input_string: JSON string containing user input data.
-    :return: A JSON string containing the result.
+    :param intent: The extracted origin, destination, and preference.
+    :return: A StageResult holding the Locations, or a failure message.
     """
+    api_key = config["API_KEY"]["geocode"]
+
+    try:
+        origin_name = f"{intent.origin}(台灣)"
+        destination_name = f"{intent.destination}(台灣)"
+
+        # Get geocode for origin and destination
+        origin, destination = get_geocodes([origin_name, destination_name], api_key)
+
+        return StageResult.ok(build_locations(origin, destination, intent.preference))
 
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of a geocoding failure
+        raise
 
+    except Exception as e:
+        # Handle errors and return a failure message
+        return StageResult.fail(str(e))
+
+
+async def resolve_async(intent: Intent) -> StageResult:
+    """
+    The asyncio version of resolve.
+
+    :param intent: The extracted origin, destination, and preference.
+    :return: A StageResult holding the Locations, or a failure message.
+    """
     api_key = config["API_KEY"]["geocode"]
 
     try:
-        # Parse the input JSON string
-        # parsed_input = json.loads(json.loads(input_string)["data"])
-        parsed_data = json.loads(input_string)["data"]
+        origin, destination = await get_geocodes_async(
+            [f"{intent.origin}(台灣)", f"{intent.destination}(台灣)"], api_key
+        )
 
-        cleaned_response = re.sub(r'```(json)?\n', '', parsed_data)  # Remove opening triple backticks
-        cleaned_response = re.sub(r'\n```', '', cleaned_response)  # Remove closing triple backticks
+        return StageResult.ok(build_locations(origin, destination, intent.preference))
 
-        cleaned_response = cleaned_response.strip()
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of a geocoding failure
+        raise
 
-        parsed_input = json.loads(cleaned_response)
+    except Exception as e:
+        # Handle errors and return a failure message
+        return StageResult.fail(str(e))
 
-        origin_name = f"{parsed_input['origin']}(台灣)"
-        destination_name = f"{parsed_input['destination']}(台灣)"
-        preference = parsed_input["preference"]
 
-        # Get geocode for origin and destination
-        origin = get_geocode(origin_name, api_key)
-        destination = get_geocode(destination_name, api_key)
-
-        # Process user preference
-        gc = process_text(preference)
-
-        # Construct the result JSON object
-        result = {
-            "result": True,
-            "data": {
-                "origin": [origin["lng"], origin["lat"]],
-                "destination": [destination["lng"], destination["lat"]],
-                "gc": gc,
-            },
-        }
+def get_result(input_string: str) -> str:
+    """
+    Process user input, fetch geocode data, and generate a result in JSON format.
 
-        return json.dumps(result)
+    :param input_string: JSON string containing user input data.
+    :return: A JSON string containing the result.
+    """
+    try:
+        # Parse the input JSON string, whose data is either an object or the JSON text returned by OpenAI
+        parsed_data = json.loads(input_string)["data"]
+        if isinstance(parsed_data, dict):
+            intent = Intent.from_dict(parsed_data)
+        else:
+            intent = Intent.from_text(parsed_data)
 
     except Exception as e:
         # Handle errors and return a failure message
-        return json.dumps({"result": False, "message": str(e)})
+        return StageResult.fail(str(e)).to_json()
+
+    result = resolve(intent)
+    if not result.result:
+        return result.to_json()
+    return result.to_json(result.data.to_dict())
 
 
 # Testing the function
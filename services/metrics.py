@@ -0,0 +1,217 @@
+import contextvars
+import logging
+import math
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+PREFIX = "route_buddy"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The trace ID of the request being handled, set per webhook event
+trace_id = contextvars.ContextVar("trace_id", default="-")
+
+
+def format_labels(labels: dict) -> str:
+    """Format labels as a Prometheus label set"""
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """A monotonically increasing counter with optional labels"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def items(self) -> list:
+        """Return (labels, value) pairs of every series"""
+        with self._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    """A latency histogram with optional labels"""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        Estimate a quantile from the buckets, returning the upper bound of the bucket it falls in.
+
+        :param q: The quantile, between 0 and 1.
+        :return: The estimated value, or 0 if nothing was observed.
+        """
+        series = self._values.get(tuple(sorted(labels.items())))
+        if not series or not series["count"]:
+            return 0.0
+        rank = q * series["count"]
+        for index, bound in enumerate(self.buckets):
+            if series["counts"][index] >= rank:
+                return bound
+        return math.inf
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._values.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+stage_duration = Histogram("stage_duration_seconds", "Duration of each pipeline stage.")
+stage_errors = Counter("stage_errors_total", "Pipeline failures by stage and failure branch.")
+http_duration = Histogram("http_request_duration_seconds", "Duration of outbound HTTP requests.")
+http_errors = Counter("http_request_errors_total", "Outbound HTTP requests that raised an error.")
+follow_ups = Counter("follow_ups_total", "Follow-up questions answered from a user's session, by kind.")
+webhook_batch_size = Histogram(
+    "webhook_batch_size", "Number of events in each webhook delivery.", (1, 2, 3, 5, 10, 20, 50, 100)
+)
+webhook_event_duration = Histogram(
+    "webhook_event_duration_seconds", "Time from the arrival of a webhook delivery until each of its events is handled."
+)
+
+registry = [stage_duration, stage_errors, http_duration, http_errors, follow_ups, webhook_batch_size,
+            webhook_event_duration]
+
+
+def register(metric):
+    """Add a metric to the /metrics output and return it"""
+    registry.append(metric)
+    return metric
+
+
+@contextmanager
+def timer(stage: str, timings: dict = None):
+    """
+    Record the duration of a pipeline stage, counting an error if it raises. Exceptions with a
+    reason attribute are counted under that reason.
+
+    :param stage: The name of the stage.
+    :param timings: A dictionary that also receives the duration under the stage name, for log_timings.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        stage_errors.inc(stage=stage, reason=getattr(e, "reason", "exception"))
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=stage)
+        if timings is not None:
+            timings[stage] = duration
+
+
+def log_timings(logger: logging.Logger, timings: dict, total: float):
+    """
+    Log the stage durations of one webhook event with its trace ID, so a single slow reply can be traced.
+
+    :param logger: The logger to write to.
+    :param timings: The durations collected by timer, by stage name.
+    :param total: The duration of the whole event in seconds.
+    """
+    stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+    logger.info("Stage timings of %s: %s, total %.3fs", trace_id.get(), stages, total)
+
+
+def record_failure(stage: str, reason: str):
+    """Count a handled failure of a pipeline stage"""
+    stage_errors.inc(stage=stage, reason=reason)
+
+
+def new_trace_id(value: str = None) -> str:
+    """Set the trace ID of the current request, generating one if no value is given"""
+    value = value or uuid.uuid4().hex[:16]
+    trace_id.set(value)
+    return value
+
+
+class TraceIdFilter(logging.Filter):
+    """Add the current trace ID to log records as record.trace_id"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def flatten_stats(stats: dict, prefix: str = PREFIX, labels: dict = None) -> list:
+    """
+    Turn the nested /stats dictionary into gauge lines. Keys that are not valid metric name
+    parts, such as host names, become a 'key' label instead.
+
+    :param stats: The statistics dictionary.
+    :return: A list of Prometheus text lines.
+    """
+    lines = []
+    labels = labels or {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key):
+                lines.extend(flatten_stats(value, f"{prefix}_{key}", labels))
+            else:
+                lines.extend(flatten_stats(value, prefix, {**labels, "key": key}))
+        elif isinstance(value, (bool, int, float)) and re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key):
+            lines.append(f"{prefix}_{key}{format_labels(labels)} {float(value)}")
+    return lines
+
+
+def render(stats: dict = None) -> str:
+    """
+    Render all metrics, and optionally the /stats dictionary as gauges, in Prometheus text format.
+
+    :param stats: The statistics dictionary.
+    :return: The exposition text.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    if stats:
+        lines.extend(flatten_stats(stats))
+    return "\n".join(lines) + "\n"
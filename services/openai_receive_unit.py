@@ -1,5 +1,12 @@
 import openai
 import json
+import unicodedata
+import services.rule_parser as rule_parser
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+from services.cache import TTLCache, SqliteStore, TieredCache
+from services.pipeline import StageResult, Intent
+from services.rate_limiter import RateLimitExceeded
 from dotenv import load_dotenv
 import os
 
@@ -13,6 +20,20 @@ load_dotenv(dotenv_path=env_path)
 
 OPENAI_API_KEY= os.getenv("OPENAI_API_KEY")
 
+# Seconds an OpenAI request may take before it fails, instead of the client's ten-minute default
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+
+# Well-formed messages are parsed locally, the LLM is only called below this confidence
+RULE_PARSER_ENABLED = os.getenv("RULE_PARSER_ENABLED", "true").lower() == "true"
+RULE_PARSER_MIN_CONFIDENCE = float(os.getenv("RULE_PARSER_MIN_CONFIDENCE", "0.8"))
+
+# Intent cache: messages the LLM has parsed are kept for INTENT_CACHE_TTL seconds, and also
+# on disk when INTENT_CACHE_PATH is set
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "1024"))
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", str(24 * 60 * 60)))
+INTENT_CACHE_PATH = os.getenv("INTENT_CACHE_PATH", "")
+INTENT_CACHE_DISK_ROWS = int(os.getenv("INTENT_CACHE_DISK_ROWS", "100000"))
+
 # Simulated config file for API key
 config = {
     "API_KEY": {
@@ -20,13 +41,52 @@ config = {
     }
 }
 
+# Parameters of the extraction request
+COMPLETION_OPTIONS = {
+    "model": "gpt-3.5-turbo",  # Specify the model
+    "temperature": 0.2,        # Controls creativity
+    "max_tokens": 500,         # Limits the output length
+    "seed": 6,                 # Ensures reproducibility
+    "timeout": OPENAI_TIMEOUT  # Fails slow requests
+}
 
-def extract_info(question: str) -> str:
+intent_cache = TieredCache(
+    TTLCache(max_size=INTENT_CACHE_SIZE, ttl=INTENT_CACHE_TTL),
+    SqliteStore(INTENT_CACHE_PATH, table="intent", max_rows=INTENT_CACHE_DISK_ROWS) if INTENT_CACHE_PATH else None,
+)
+
+_async_client = None
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """Return the shared asyncio OpenAI client, creating it on first use"""
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI(api_key=config['API_KEY']['openai'])
+    return _async_client
+
+
+def normalize_message(text: str) -> str:
     """
-    Sends a prompt to OpenAI API to extract origin, destination, and preference.
+    Normalize a message into an intent cache key, so that messages differing only in width,
+    spacing, case or punctuation share an entry.
+
+    :param text: The user-provided sentence.
+    :return: The normalized sentence.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return "".join(
+        char for char in text.lower()
+        if not char.isspace() and not unicodedata.category(char).startswith("P")
+    )
+
+
+def build_messages(question: str) -> list:
+    """
+    Builds the chat messages asking OpenAI to extract origin, destination, and preference.
 
     :param question: The input sentence containing travel details.
-    :return: The generated response content from OpenAI API.
+    :return: The system and user messages.
     """
     # Define the system message for OpenAI
     system_message = {
@@ -53,20 +113,62 @@ def extract_info(question: str) -> str:
         "content": prompt
     }
 
+    return [system_message, user_message]
+
+
+def extract_info(question: str) -> str:
+    """
+    Sends a prompt to OpenAI API to extract origin, destination, and preference.
+
+    :param question: The input sentence containing travel details.
+    :return: The generated response content from OpenAI API.
+    """
     # Send the request to OpenAI ChatCompletion API
     try:
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",  # Specify the model
-            messages=[system_message, user_message],
-            temperature=0.2,       # Controls creativity
-            max_tokens=500,        # Limits the output length
-            seed=6                 # Ensures reproducibility
+        rate_limiter.acquire("openai", config['API_KEY']['openai'])
+        response = circuit_breaker.breakers["openai"].call(
+            openai.chat.completions.create, messages=build_messages(question), **COMPLETION_OPTIONS
         )
 
         # Extract the response content from the API output
         content = response.choices[0].message.content.strip()
         return content
 
+    except RateLimitExceeded:
+        raise
+
+    except openai.RateLimitError as e:
+        raise rate_limiter.throttled(
+            "openai", config['API_KEY']['openai'], rate_limiter.parse_retry_after(e.response.headers)
+        )
+
+    except Exception as e:
+        # Return error details if the API call fails
+        return f"Error: {str(e)}"
+
+
+async def extract_info_async(question: str) -> str:
+    """
+    Sends a prompt to OpenAI API with the asyncio client to extract origin, destination, and preference.
+
+    :param question: The input sentence containing travel details.
+    :return: The generated response content from OpenAI API.
+    """
+    try:
+        await rate_limiter.acquire_async("openai", config['API_KEY']['openai'])
+        response = await circuit_breaker.breakers["openai"].call_async(
+            get_async_client().chat.completions.create, messages=build_messages(question), **COMPLETION_OPTIONS
+        )
+        return response.choices[0].message.content.strip()
+
+    except RateLimitExceeded:
+        raise
+
+    except openai.RateLimitError as e:
+        raise rate_limiter.throttled(
+            "openai", config['API_KEY']['openai'], rate_limiter.parse_retry_after(e.response.headers)
+        )
+
     except Exception as e:
         # Return error details if the API call fails
         return f"Error: {str(e)}"
@@ -82,39 +184,143 @@ def is_valid_result(result: str) -> bool:
     return "error" not in result
 
 
-def get_result(input_string: str) -> str:
+def parse_rules(input_string: str):
+    """
+    Try the local rules, so well-formed messages skip the OpenAI round-trip.
+
+    :param input_string: The user-provided sentence.
+    :return: A StageResult holding an Intent, or None if the rules are not confident enough.
+    """
+    if not RULE_PARSER_ENABLED:
+        return None
+
+    parsed, confidence = rule_parser.parse(input_string)
+    rule_parser.record(confidence >= RULE_PARSER_MIN_CONFIDENCE)
+
+    if confidence >= RULE_PARSER_MIN_CONFIDENCE:
+        return StageResult.ok(Intent.from_dict(parsed))
+    return None
+
+
+def parse_extraction(result: str) -> StageResult:
+    """
+    Validate the content returned by OpenAI and parse it into an Intent.
+
+    :param result: The response content from OpenAI API.
+    :return: A StageResult holding an Intent, or a failure message.
+    """
+    if result.startswith("Error: "):
+        return StageResult.fail(result[len("Error: "):])
+
+    # Validate the result
+    if not is_valid_result(result):
+        return StageResult.fail('Origin or destination is not correct')
+
+    try:
+        intent = Intent.from_text(result)
+    except (ValueError, KeyError, TypeError):
+        return StageResult.fail('Origin or destination is not correct')
+
+    # Return success response with extracted data
+    return StageResult.ok(intent)
+
+
+def get_cached_intent(input_string: str):
+    """
+    Look up a message in the intent cache.
+
+    :param input_string: The user-provided sentence.
+    :return: A StageResult holding the cached Intent, or None on a miss.
+    """
+    cached = intent_cache.get(normalize_message(input_string))
+    if cached is None:
+        return None
+    return StageResult.ok(Intent.from_dict(cached))
+
+
+async def get_cached_intent_async(input_string: str):
+    """The asyncio version of get_cached_intent, which reads the on-disk cache in a worker thread"""
+    cached = await intent_cache.get_async(normalize_message(input_string))
+    if cached is None:
+        return None
+    return StageResult.ok(Intent.from_dict(cached))
+
+
+def cache_intent(input_string: str, result: StageResult) -> StageResult:
+    """Store a successfully extracted intent in the cache and return the result unchanged"""
+    if result.result:
+        intent_cache.set(normalize_message(input_string), result.data.to_dict())
+    return result
+
+
+async def cache_intent_async(input_string: str, result: StageResult) -> StageResult:
+    """The asyncio version of cache_intent, which writes to the on-disk cache in a worker thread"""
+    if result.result:
+        await intent_cache.set_async(normalize_message(input_string), result.data.to_dict())
+    return result
+
+
+def extract_intent(input_string: str) -> StageResult:
     """
     Main function to process input, call OpenAI API, and validate the result.
 
-    :param input_string: The user-provided sentence in JSON format.
-    :return: A JSON-formatted string containing success or failure message.
+    :param input_string: The user-provided sentence.
+    :return: A StageResult holding an Intent, or a failure message.
     """
+    result = parse_rules(input_string) or get_cached_intent(input_string)
+    if result is not None:
+        return result
+
     # Set the OpenAI API key
     openai.api_key = config['API_KEY']['openai']
 
     try:
         # Call the extract_info function to get the AI response
-        result = extract_info(input_string)
+        return cache_intent(input_string, parse_extraction(extract_info(input_string)))
 
-        # Validate the result
-        if not is_valid_result(result):
-            return json.dumps({
-                'result': False,
-                'message': 'Origin or destination is not correct'
-            }, ensure_ascii=False)
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of an OpenAI error
+        raise
+
+    except Exception as e:
+        # Handle and return any errors that occur
+        return StageResult.fail(str(e))
 
-        # Return success response with extracted data
-        return json.dumps({
-            'result': True,
-            'data': result
-        }, ensure_ascii=False)
+
+async def extract_intent_async(input_string: str) -> StageResult:
+    """
+    The asyncio version of extract_intent.
+
+    :param input_string: The user-provided sentence.
+    :return: A StageResult holding an Intent, or a failure message.
+    """
+    result = parse_rules(input_string) or await get_cached_intent_async(input_string)
+    if result is not None:
+        return result
+
+    try:
+        return await cache_intent_async(input_string, parse_extraction(await extract_info_async(input_string)))
+
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of an OpenAI error
+        raise
 
     except Exception as e:
         # Handle and return any errors that occur
-        return json.dumps({
-            'result': False,
-            'message': str(e)
-        }, ensure_ascii=False)
+        return StageResult.fail(str(e))
+
+
+def get_result(input_string: str) -> str:
+    """
+    Extract the origin, destination, and preference from a sentence.
+
+    :param input_string: The user-provided sentence.
+    :return: A JSON-formatted string containing success or failure message.
+    """
+    result = extract_intent(input_string)
+    if not result.result:
+        return result.to_json()
+    return result.to_json(json.dumps(result.data.to_dict(), ensure_ascii=False))
 
 
 if __name__ == '__main__':
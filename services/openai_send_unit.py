@@ -1,5 +1,15 @@
 import openai
 import json
+import logging
+import time
+import services.route_renderer as route_renderer
+import services.route_projection as route_projection
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+import services.route_fingerprint as route_fingerprint
+from services.cache import TTLCache, SqliteStore, TieredCache
+from services.pipeline import StageResult, Intent, Route
+from services.rate_limiter import RateLimitExceeded
 from dotenv import load_dotenv
 import os
 
@@ -13,6 +23,26 @@ load_dotenv(dotenv_path=env_path)
 
 OPENAI_API_KEY= os.getenv("OPENAI_API_KEY")
 
+# Seconds an OpenAI request may take before it fails, instead of the client's ten-minute default
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+
+# How the itinerary is produced: "template" renders it locally, "polish" lets OpenAI rewrite the
+# rendered text, and "llm" asks OpenAI to write it from the route JSON
+ROUTE_RENDER_MODE = os.getenv("ROUTE_RENDER_MODE", "template").lower()
+
+# Receive the itinerary completions of the polish and llm modes as a stream, only to log the time to the
+# first token: the reply is still sent once the whole text has arrived. STREAMING_REPLY is the former name
+LOG_FIRST_TOKEN = os.getenv("LOG_FIRST_TOKEN", os.getenv("STREAMING_REPLY", "false")).lower() == "true"
+
+# Itinerary cache: itineraries written by OpenAI are kept for ITINERARY_CACHE_TTL seconds under a
+# fingerprint of their route, and also on disk when ITINERARY_CACHE_PATH is set
+ITINERARY_CACHE_SIZE = int(os.getenv("ITINERARY_CACHE_SIZE", "1024"))
+ITINERARY_CACHE_TTL = float(os.getenv("ITINERARY_CACHE_TTL", str(24 * 60 * 60)))
+ITINERARY_CACHE_PATH = os.getenv("ITINERARY_CACHE_PATH", "")
+ITINERARY_CACHE_DISK_ROWS = int(os.getenv("ITINERARY_CACHE_DISK_ROWS", "100000"))
+
+logger = logging.getLogger(__name__)
+
 # Simulated config file for API key
 config = {
     "API_KEY": {
@@ -20,12 +50,129 @@ config = {
     }
 }
 
-def extract_info(question: str) -> str:
+# Parameters of the itinerary requests
+COMPLETION_OPTIONS = {
+    "model": "gpt-3.5-turbo",
+    "temperature": 0,
+    "max_tokens": 1024,
+    "seed": 6,
+    "timeout": OPENAI_TIMEOUT
+}
+
+itinerary_cache = TieredCache(
+    TTLCache(max_size=ITINERARY_CACHE_SIZE, ttl=ITINERARY_CACHE_TTL),
+    SqliteStore(ITINERARY_CACHE_PATH, table="itinerary", max_rows=ITINERARY_CACHE_DISK_ROWS)
+    if ITINERARY_CACHE_PATH else None,
+)
+
+_async_client = None
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """Return the shared asyncio OpenAI client, creating it on first use"""
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI(api_key=config['API_KEY']['openai'])
+    return _async_client
+
+
+def create_completion(messages: list) -> str:
     """
-    Sends a prompt to the OpenAI API and retrieves the generated content.
+    Sends messages to the OpenAI Chat API once the rate limiter admits them, failing fast while
+    its circuit breaker is open, and returns the generated content.
+
+    :param messages: The chat messages.
+    :return: The generated content.
+    """
+    rate_limiter.acquire("openai", config['API_KEY']['openai'])
+    try:
+        return circuit_breaker.breakers["openai"].call(complete, messages)
+    except openai.RateLimitError as e:
+        raise rate_limiter.throttled(
+            "openai", config['API_KEY']['openai'], rate_limiter.parse_retry_after(e.response.headers)
+        )
+
+
+def complete(messages: list) -> str:
+    """
+    Sends messages to the OpenAI Chat API and returns the generated content.
+
+    When LOG_FIRST_TOKEN is enabled, the completion is streamed to log the time to the first
+    token, and returned once the last chunk arrives.
+
+    :param messages: The chat messages.
+    :return: The generated content.
+    """
+    if not LOG_FIRST_TOKEN:
+        response = openai.chat.completions.create(messages=messages, **COMPLETION_OPTIONS)
+        return response.choices[0].message.content.strip()
+
+    start = time.perf_counter()
+    first_token = None
+    chunks = []
+
+    stream = openai.chat.completions.create(messages=messages, stream=True, **COMPLETION_OPTIONS)
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            chunks.append(chunk.choices[0].delta.content)
+
+    logger.info(
+        "OpenAI stream finished: first token %.3fs, total %.3fs",
+        first_token or 0.0, time.perf_counter() - start
+    )
+    return "".join(chunks).strip()
+
+
+async def create_completion_async(messages: list) -> str:
+    """
+    The asyncio version of create_completion.
+
+    :param messages: The chat messages.
+    :return: The generated content.
+    """
+    await rate_limiter.acquire_async("openai", config['API_KEY']['openai'])
+    try:
+        return await circuit_breaker.breakers["openai"].call_async(complete_async, messages)
+    except openai.RateLimitError as e:
+        raise rate_limiter.throttled(
+            "openai", config['API_KEY']['openai'], rate_limiter.parse_retry_after(e.response.headers)
+        )
+
+
+async def complete_async(messages: list) -> str:
+    """The asyncio version of complete"""
+    client = get_async_client()
+
+    if not LOG_FIRST_TOKEN:
+        response = await client.chat.completions.create(messages=messages, **COMPLETION_OPTIONS)
+        return response.choices[0].message.content.strip()
+
+    start = time.perf_counter()
+    first_token = None
+    chunks = []
+
+    stream = await client.chat.completions.create(messages=messages, stream=True, **COMPLETION_OPTIONS)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            chunks.append(chunk.choices[0].delta.content)
+
+    logger.info(
+        "OpenAI stream finished: first token %.3fs, total %.3fs",
+        first_token or 0.0, time.perf_counter() - start
+    )
+    return "".join(chunks).strip()
+
+
+def build_itinerary_messages(question: str) -> list:
+    """
+    Builds the chat messages asking OpenAI to write the itinerary.
 
     :param question: The input JSON text containing travel data.
-    :return: The generated response text.
+    :return: The system and user messages.
     """
     # Define the system message to set up the assistant's role
     system_message = {
@@ -57,48 +204,326 @@ json text:
     }
 
     # Combine system and user messages
-    messages = [system_message, user_message]
+    return [system_message, user_message]
+
+
+def extract_info(question: str) -> str:
+    """
+    Sends a prompt to the OpenAI API and retrieves the generated content.
+
+    :param question: The input JSON text containing travel data.
+    :return: The generated response text.
+    """
+    try:
+        # Send a request to OpenAI Chat API and extract the response content
+        return create_completion(build_itinerary_messages(question))
+
+    except RateLimitExceeded:
+        raise
+
+    except Exception as e:
+        # Return an error message if the request fails
+        return f"Error: {str(e)}"
 
+
+async def extract_info_async(question: str) -> str:
+    """The asyncio version of extract_info"""
     try:
-        # Send a request to OpenAI Chat API
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0,
-            max_tokens=1024,
-            seed=6
-        )
+        return await create_completion_async(build_itinerary_messages(question))
 
-        # Extract the response content
-        # response_content = response['choices'][0]['message']['content'].strip()
-        response_content = response.choices[0].message.content.strip()
-        return response_content
+    except RateLimitExceeded:
+        raise
 
     except Exception as e:
         # Return an error message if the request fails
         return f"Error: {str(e)}"
 
 
-def get_result(input_string: str) -> str:
+def build_polish_messages(draft: str) -> list:
     """
-    Processes the input, calls extract_info, and returns a JSON result.
+    Builds the chat messages asking OpenAI to rewrite a rendered itinerary.
 
-    :param input_string: The input JSON string with travel information.
-    :return: A JSON-formatted result containing the response or an error message.
+    :param draft: The itinerary rendered by route_renderer.
+    :return: The system and user messages.
+    """
+    prompt = f"""
+Rewrite the travel instructions below in traditional Chinese colloquially, as an enthusiastic tour guide talking to only one person.
+Notice:
+- Keep every number, time, date, fare, station and line name exactly as written.
+- Keep the numbered sections and their order.
+- Don't use markdown syntax.
+
+travel instructions:
+{draft}
+"""
+    return [
+        {"role": "system", "content": "You are a friendly tour guide who rewrites text without changing its facts."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def polish_info(draft: str) -> str:
+    """
+    Sends a rendered itinerary to the OpenAI API to make it sound more conversational.
+
+    :param draft: The itinerary rendered by route_renderer.
+    :return: The rewritten itinerary text.
+    """
+    try:
+        return create_completion(build_polish_messages(draft))
+
+    except Exception as e:
+        # Return an error message if the request fails
+        return f"Error: {str(e)}"
+
+
+async def polish_info_async(draft: str) -> str:
+    """The asyncio version of polish_info"""
+    try:
+        return await create_completion_async(build_polish_messages(draft))
+
+    except Exception as e:
+        # Return an error message if the request fails
+        return f"Error: {str(e)}"
+
+
+def get_cached(key, route_data: dict):
+    """
+    Look up an itinerary written for a route with the same fingerprint.
+
+    :param key: The route fingerprint, or None if the route has none.
+    :param route_data: The 'data' object of the TDX response, whose times are written into the itinerary.
+    :return: The itinerary text, or None on a miss.
+    """
+    if key is None:
+        return None
+
+    template = itinerary_cache.get(key)
+    if template is None:
+        return None
+    return route_fingerprint.fill_template(route_data, template)
+
+
+def set_cached(key, route_data: dict, text: str):
+    """Store an itinerary written by OpenAI, unless its times cannot be traced back to the route"""
+    if key is None:
+        return
+
+    template = route_fingerprint.to_template(route_data, text)
+    if template is not None:
+        itinerary_cache.set(key, template)
+
+
+async def get_cached_async(key, route_data: dict):
+    """The asyncio version of get_cached, which reads the on-disk cache in a worker thread"""
+    if key is None:
+        return None
+
+    template = await itinerary_cache.get_async(key)
+    if template is None:
+        return None
+    return route_fingerprint.fill_template(route_data, template)
+
+
+async def set_cached_async(key, route_data: dict, text: str):
+    """The asyncio version of set_cached, which writes to the on-disk cache in a worker thread"""
+    if key is None:
+        return
+
+    template = route_fingerprint.to_template(route_data, text)
+    if template is not None:
+        await itinerary_cache.set_async(key, template)
+
+
+def render_template(route_data: dict):
+    """
+    Render the itinerary with route_renderer.
+
+    :param route_data: The 'data' object of the TDX response.
+    :return: The itinerary text, or None if the route could not be rendered locally.
+    """
+    try:
+        return route_renderer.render(route_data)
+    except (KeyError, IndexError, TypeError, ValueError):
+        logger.exception("Failed to render the route locally, falling back to OpenAI")
+        return None
+
+
+def render_locally(route_data: dict):
+    """
+    Render the itinerary with route_renderer, letting OpenAI polish it in the "polish" mode.
+
+    :param route_data: The 'data' object of the TDX response.
+    :return: The itinerary text, or None if the route could not be rendered locally.
+    """
+    result = render_template(route_data)
+
+    if result is not None and ROUTE_RENDER_MODE == "polish":
+        key = route_fingerprint.fingerprint(route_data, "polish")
+        cached = get_cached(key, route_data)
+        if cached is not None:
+            return cached
+
+        openai.api_key = config['API_KEY']['openai']
+        polished = polish_info(result)
+        # Keep the rendered text when the polish call fails or OpenAI is busy
+        if not polished.startswith("Error: "):
+            result = polished
+            set_cached(key, route_data, result)
+
+    return result
+
+
+async def render_locally_async(route_data: dict):
+    """The asyncio version of render_locally"""
+    result = render_template(route_data)
+
+    if result is not None and ROUTE_RENDER_MODE == "polish":
+        key = route_fingerprint.fingerprint(route_data, "polish")
+        cached = await get_cached_async(key, route_data)
+        if cached is not None:
+            return cached
+
+        polished = await polish_info_async(result)
+        # Keep the rendered text when the polish call fails or OpenAI is busy
+        if not polished.startswith("Error: "):
+            result = polished
+            await set_cached_async(key, route_data, result)
+
+    return result
+
+
+def parse_itinerary(result: str) -> StageResult:
+    """Wrap the text returned by extract_info into a StageResult"""
+    if result.startswith("Error: "):
+        return StageResult.fail(result[len("Error: "):])
+    return StageResult.ok(result)
+
+
+def write_itinerary(input_string: str) -> StageResult:
+    """
+    Calls extract_info to let OpenAI write the itinerary.
+
+    :param input_string: The input JSON text with travel information.
+    :return: A StageResult holding the itinerary text, or a failure message.
     """
     # Set the OpenAI API key
     openai.api_key = config['API_KEY']['openai']
 
     try:
         # Call the extract_info function to get the response from OpenAI
-        result = extract_info(input_string)
+        return parse_itinerary(extract_info(input_string))
+
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of a rendering failure
+        raise
+
+    except Exception as e:
+        # Handle errors and return a failure response
+        return StageResult.fail(str(e))
+
+
+def intent_context(intent: Intent = None) -> str:
+    """Serialize the intent given to OpenAI as context, or return an empty string without one"""
+    return json.dumps(intent.to_dict(), ensure_ascii=False) if intent is not None else ""
+
+
+def build_prompt(route: Route, intent: Intent = None) -> str:
+    """
+    Combine the intent and the first route candidate for the prompt, keeping only the route fields
+    the itinerary needs.
+    """
+    context = intent_context(intent)
+    routes = route.data.get("routes", [])
+    data = {**route.data, "routes": routes[:1]}
+
+    # The response size covers every candidate, so the first one is counted as its share of the body
+    input_bytes = route.size // max(len(routes), 1)
+    return f"{context}{route_projection.dumps(data, input_bytes)}"
+
+
+def render(route: Route, intent: Intent = None) -> StageResult:
+    """
+    Produce the user-friendly itinerary of a route, locally or with OpenAI.
+
+    :param route: The route returned by TDX.
+    :param intent: The extracted origin, destination, and preference, given to OpenAI as context.
+    :return: A StageResult holding the itinerary text, or a failure message.
+    """
+    # Render the itinerary locally unless the LLM-only mode is selected
+    if ROUTE_RENDER_MODE in ("template", "polish"):
+        result = render_locally(route.data)
+        if result is not None:
+            return StageResult.ok(result)
 
-        # Wrap the response in a JSON result
-        return json.dumps({'result': True, 'data': result}, ensure_ascii=False)
+    # Reuse the itinerary OpenAI wrote for the same route at another departure time
+    key = route_fingerprint.fingerprint(route.data, "llm", intent_context(intent))
+    cached = get_cached(key, route.data)
+    if cached is not None:
+        return StageResult.ok(cached)
+
+    result = write_itinerary(build_prompt(route, intent))
+    if result.result:
+        set_cached(key, route.data, result.data)
+    return result
+
+
+async def render_async(route: Route, intent: Intent = None) -> StageResult:
+    """
+    The asyncio version of render.
+
+    :param route: The route returned by TDX.
+    :param intent: The extracted origin, destination, and preference, given to OpenAI as context.
+    :return: A StageResult holding the itinerary text, or a failure message.
+    """
+    if ROUTE_RENDER_MODE in ("template", "polish"):
+        result = await render_locally_async(route.data)
+        if result is not None:
+            return StageResult.ok(result)
+
+    key = route_fingerprint.fingerprint(route.data, "llm", intent_context(intent))
+    cached = await get_cached_async(key, route.data)
+    if cached is not None:
+        return StageResult.ok(cached)
+
+    try:
+        result = parse_itinerary(await extract_info_async(build_prompt(route, intent)))
+
+    except RateLimitExceeded:
+        # Let ApiManager answer with the busy message instead of a rendering failure
+        raise
 
     except Exception as e:
-        # Handle errors and return a JSON error response
-        return json.dumps({'result': False, 'message': str(e)}, ensure_ascii=False)
+        # Handle errors and return a failure response
+        return StageResult.fail(str(e))
+
+    if result.result:
+        await set_cached_async(key, route.data, result.data)
+    return result
+
+
+def get_result(input_string: str, route_data: dict = None) -> str:
+    """
+    Processes the input, renders or calls extract_info, and returns a JSON result.
+
+    :param input_string: The input JSON string with travel information.
+    :param route_data: The 'data' object of the TDX response, used by the local renderer and the itinerary cache.
+    :return: A JSON-formatted result containing the response or an error message.
+    """
+    if route_data is not None and ROUTE_RENDER_MODE in ("template", "polish"):
+        result = render_locally(route_data)
+        if result is not None:
+            return StageResult.ok(result).to_json()
+
+    key = route_fingerprint.fingerprint(route_data, "llm") if route_data is not None else None
+    cached = get_cached(key, route_data)
+    if cached is not None:
+        return StageResult.ok(cached).to_json()
+
+    result = write_itinerary(input_string)
+    if result.result:
+        set_cached(key, route_data, result.data)
+    return result.to_json()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+import json
+import re
+
+
+class StageResult:
+    """
+    The outcome of one pipeline stage, passed between units in-process.
+
+    It mirrors the {'result', 'data', 'message'} JSON the units return from get_result,
+    which is only produced at the boundary by to_json().
+    """
+
+    __slots__ = ("result", "data", "message")
+
+    def __init__(self, result: bool, data=None, message: str = ""):
+        self.result = result
+        self.data = data
+        self.message = message
+
+    @classmethod
+    def ok(cls, data) -> "StageResult":
+        return cls(True, data=data)
+
+    @classmethod
+    def fail(cls, message: str) -> "StageResult":
+        return cls(False, message=message)
+
+    def to_json(self, data=None) -> str:
+        """
+        Serialize the result into the JSON format of get_result.
+
+        :param data: A JSON-serializable replacement for self.data.
+        :return: A JSON-formatted string.
+        """
+        if not self.result:
+            return json.dumps({'result': False, 'message': self.message}, ensure_ascii=False)
+        return json.dumps({'result': True, 'data': self.data if data is None else data}, ensure_ascii=False)
+
+
+class Intent:
+    """The origin, destination, and preference extracted from a user's message"""
+
+    __slots__ = ("origin", "destination", "preference")
+
+    def __init__(self, origin: str, destination: str, preference: str):
+        self.origin = origin
+        self.destination = destination
+        self.preference = preference
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Intent":
+        return cls(data["origin"], data["destination"], data["preference"])
+
+    @classmethod
+    def from_text(cls, text: str) -> "Intent":
+        """
+        Parse the JSON text returned by OpenAI, which may be wrapped in a markdown code block.
+
+        :param text: The JSON text.
+        :return: The parsed intent.
+        """
+        cleaned_response = re.sub(r'```(json)?\n', '', text)  # Remove opening triple backticks
+        cleaned_response = re.sub(r'\n```', '', cleaned_response)  # Remove closing triple backticks
+        return cls.from_dict(json.loads(cleaned_response.strip()))
+
+    def to_dict(self) -> dict:
+        return {"origin": self.origin, "destination": self.destination, "preference": self.preference}
+
+
+class Locations:
+    """The coordinates of the origin and destination, as [longitude, latitude], with the TDX preference code"""
+
+    __slots__ = ("origin", "destination", "gc")
+
+    def __init__(self, origin: list, destination: list, gc: int):
+        self.origin = origin
+        self.destination = destination
+        self.gc = gc
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Locations":
+        return cls(data["origin"], data["destination"], data["gc"])
+
+    def to_dict(self) -> dict:
+        return {"origin": self.origin, "destination": self.destination, "gc": self.gc}
+
+
+class Route:
+    """The 'data' object of a TDX routing response, with the size of the response body in bytes"""
+
+    __slots__ = ("data", "size")
+
+    def __init__(self, data: dict, size: int = 0):
+        self.data = data
+        self.size = size
@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import threading
+import time
+from dotenv import load_dotenv
+import os
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Requests per second and burst size of each upstream, as "rate/burst"; empty means unlimited.
+# Every API key gets its own bucket with these limits.
+RATE_LIMITS = {
+    "geocode": os.getenv("RATE_LIMIT_GEOCODE", "50/50"),
+    "tdx": os.getenv("RATE_LIMIT_TDX", "5/5"),
+    "openai": os.getenv("RATE_LIMIT_OPENAI", ""),
+}
+
+# Limits of specific API keys, e.g. "tdx:CLIENT_ID=20/20,openai:sk-...=10/10"
+RATE_LIMIT_OVERRIDES = os.getenv("RATE_LIMIT_OVERRIDES", "")
+
+# A request waits at most RATE_LIMIT_MAX_WAIT seconds for its turn, with at most
+# RATE_LIMIT_MAX_QUEUE requests waiting per bucket; beyond that it is rejected
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "100"))
+
+
+class RateLimitExceeded(Exception):
+    """Raised when an upstream is too busy for a request to wait its turn"""
+
+    # Counted under this failure branch by metrics.timer
+    reason = "rate_limited"
+
+    def __init__(self, upstream: str, retry_after: float = 0.0):
+        super().__init__(f"Rate limit of {upstream} exceeded, retry after {retry_after:.1f} seconds")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def parse_limit(value: str):
+    """
+    Parse a "rate/burst" limit.
+
+    :param value: The limit, such as "5/10"; a bare rate uses the rate as the burst.
+    :return: A (rate, burst) tuple, or None if the value is empty.
+    """
+    if not value.strip():
+        return None
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+def parse_overrides(value: str) -> dict:
+    """
+    Parse the per-key limits setting.
+
+    :param value: A comma-separated list of upstream:api_key=rate/burst items.
+    :return: A dictionary mapping (upstream, api_key) to (rate, burst).
+    """
+    overrides = {}
+    for item in value.split(","):
+        if ":" in item and "=" in item:
+            name, limit = item.rsplit("=", 1)
+            upstream, api_key = name.split(":", 1)
+            overrides[(upstream.strip(), api_key.strip())] = parse_limit(limit)
+    return overrides
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket whose callers wait in line for their token.
+
+    Each caller reserves the next token and sleeps until it is due, so waiting callers are
+    admitted in order at the configured rate. A caller whose wait would exceed max_wait, or
+    who would join more than max_queue waiting callers, is rejected instead.
+    """
+
+    def __init__(self, upstream: str, rate: float, burst: float,
+                 max_wait: float = RATE_LIMIT_MAX_WAIT, max_queue: int = RATE_LIMIT_MAX_QUEUE):
+        self.upstream = upstream
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = 0
+        self._counters = {"admitted": 0, "delayed": 0, "rejected": 0, "throttled": 0}
+
+    def reserve(self) -> float:
+        """
+        Take the next token.
+
+        :return: The number of seconds to wait before the token may be used.
+        """
+        with self._lock:
+            now = self._refill()
+
+            wait = max(0.0, (1 - self._tokens) / self.rate, self._paused_until - now)
+            if wait > 0 and (wait > self.max_wait or self._waiting >= self.max_queue):
+                self._counters["rejected"] += 1
+                raise RateLimitExceeded(self.upstream, wait)
+
+            self._tokens -= 1
+            self._counters["admitted"] += 1
+            if wait > 0:
+                self._counters["delayed"] += 1
+                self._waiting += 1
+            return wait
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right away, for optional requests such as hedges"""
+        with self._lock:
+            now = self._refill()
+            if self._tokens < 1 or now < self._paused_until:
+                return False
+            self._tokens -= 1
+            self._counters["admitted"] += 1
+            return True
+
+    def _refill(self) -> float:
+        # Must be called with the lock held, returns the current time
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def _done_waiting(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def acquire(self):
+        """Wait for a token, raising RateLimitExceeded if the wait would be too long"""
+        wait = self.reserve()
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._done_waiting()
+
+    async def acquire_async(self):
+        """The asyncio version of acquire"""
+        wait = self.reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._done_waiting()
+
+    def pause(self, seconds: float):
+        """Hold back every request for some seconds, after the upstream answered HTTP 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+            self._counters["throttled"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, "waiting": self._waiting, **self._counters}
+
+
+_lock = threading.Lock()
+_buckets = {}
+_overrides = parse_overrides(RATE_LIMIT_OVERRIDES)
+
+
+def key_id(api_key: str) -> str:
+    """Return a short digest of an API key, so keys are never shown in stats"""
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+
+
+def get_bucket(upstream: str, api_key: str = ""):
+    """
+    Return the bucket of an upstream and API key, creating it on first use.
+
+    :param upstream: 'geocode', 'tdx', or 'openai'.
+    :param api_key: The API key or client ID the requests are sent with.
+    :return: The TokenBucket, or None if the upstream is unlimited.
+    """
+    key = (upstream, api_key or "")
+    with _lock:
+        if key not in _buckets:
+            limit = _overrides.get(key) or parse_limit(RATE_LIMITS.get(upstream, ""))
+            _buckets[key] = TokenBucket(upstream, *limit) if limit else None
+        return _buckets[key]
+
+
+def acquire(upstream: str, api_key: str = ""):
+    """Wait for the turn of a request to an upstream"""
+    bucket = get_bucket(upstream, api_key)
+    if bucket is not None:
+        bucket.acquire()
+
+
+async def acquire_async(upstream: str, api_key: str = ""):
+    """The asyncio version of acquire"""
+    bucket = get_bucket(upstream, api_key)
+    if bucket is not None:
+        await bucket.acquire_async()
+
+
+def try_acquire(upstream: str, api_key: str = "") -> bool:
+    """Take a token for an optional request only if it needs no waiting"""
+    bucket = get_bucket(upstream, api_key)
+    return bucket is None or bucket.try_acquire()
+
+
+def throttled(upstream: str, api_key: str = "", retry_after: float = None) -> RateLimitExceeded:
+    """
+    Record that an upstream answered HTTP 429, holding back further requests.
+
+    :param upstream: 'geocode', 'tdx', or 'openai'.
+    :param api_key: The API key or client ID the request was sent with.
+    :param retry_after: The seconds the upstream asked to wait, defaulting to one token interval.
+    :return: The exception to raise to the caller.
+    """
+    bucket = get_bucket(upstream, api_key)
+    if retry_after is None:
+        retry_after = 1 / bucket.rate if bucket is not None else 1.0
+    if bucket is not None:
+        bucket.pause(retry_after)
+    return RateLimitExceeded(upstream, retry_after)
+
+
+def parse_retry_after(headers) -> float:
+    """Return the Retry-After header in seconds, or None if it is missing or a date"""
+    value = (headers or {}).get("Retry-After", "")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def stats() -> dict:
+    """Return the counters of every bucket, keyed by upstream and API key digest"""
+    with _lock:
+        buckets = {key: bucket for key, bucket in _buckets.items() if bucket is not None}
+    return {f"{upstream}:{key_id(api_key)}": bucket.stats() for (upstream, api_key), bucket in buckets.items()}
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import re
+from datetime import datetime, timedelta
+import services.route_renderer as route_renderer
+import services.route_projection as route_projection
+
+# Times and dates an itinerary may mention, which must all come from the route to be shifted
+CLOCK_PATTERN = re.compile(r"\d{1,2}:\d{2}|\d{1,2}/\d{1,2}")
+
+
+def first_route(data: dict):
+    """Return the projected first route of the TDX data with its departure time, or (None, None)"""
+    routes = route_projection.project({"routes": data.get("routes", [])[:1]})["routes"]
+    if not routes:
+        return None, None
+
+    route = routes[0]
+    try:
+        return route, datetime.fromisoformat(route["start_time"])
+    except (TypeError, ValueError):
+        return None, None
+
+
+def offset(value: str, departure: datetime) -> int:
+    """Return the seconds from the departure to a TDX timestamp"""
+    return round((datetime.fromisoformat(value) - departure).total_seconds())
+
+
+def route_times(route: dict) -> list:
+    """Return every timestamp of a projected route: its departure and arrival, then those of its sections"""
+    times = [route["start_time"], route["end_time"]]
+    for section in route["sections"]:
+        times.extend([section["departure"]["time"], section["arrival"]["time"]])
+    return [value for value in times if value]
+
+
+def relative(route: dict, departure: datetime) -> dict:
+    """Replace the timestamps of a projected route with their offsets from the departure"""
+    sections = []
+    for section in route["sections"]:
+        sections.append({
+            **section,
+            "departure": {**section["departure"], "time": offset(section["departure"]["time"], departure)},
+            "arrival": {**section["arrival"], "time": offset(section["arrival"]["time"], departure)},
+        })
+    return {**route, "start_time": 0, "end_time": offset(route["end_time"], departure), "sections": sections}
+
+
+def fingerprint(data: dict, *context: str):
+    """
+    Hash the fields of the first route that an itinerary is written from: its sections, transport
+    modes and names, places, fares, and times relative to the departure. Routes that only differ by
+    their departure time share a fingerprint.
+
+    :param data: The 'data' object of the TDX routing response.
+    :param context: Other inputs of the itinerary, such as the render mode and the intent.
+    :return: The hex digest, or None if the route has no usable times.
+    """
+    route, departure = first_route(data)
+    if route is None:
+        return None
+
+    try:
+        fields = relative(route, departure)
+    except (TypeError, ValueError):
+        return None
+
+    text = json.dumps([list(context), fields], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def to_template(data: dict, text: str):
+    """
+    Turn an itinerary into a template whose times are offsets from the route's departure.
+
+    :param data: The 'data' object of the TDX routing response the itinerary was written from.
+    :param text: The itinerary text.
+    :return: A list alternating text and offsets in seconds, or None if a time in the text cannot
+        be traced back to exactly one time of the route.
+    """
+    route, departure = first_route(data)
+    if route is None:
+        return None
+
+    # Map each formatted time to its offset, giving up when two offsets share a minute
+    offsets = {}
+    try:
+        for value in route_times(route):
+            formatted = route_renderer.format_time(value)
+            seconds = offset(value, departure)
+            if offsets.setdefault(formatted, seconds) != seconds:
+                return None
+    except (TypeError, ValueError):
+        return None
+
+    if not offsets:
+        return None
+
+    pattern = "|".join(re.escape(formatted) for formatted in offsets)
+    parts = re.split(f"({pattern})", text)
+    template = [part if index % 2 == 0 else offsets[part] for index, part in enumerate(parts)]
+
+    # Times written in another format would keep the old departure
+    if any(CLOCK_PATTERN.search(part) for part in template[::2]):
+        return None
+    return template
+
+
+def fill_template(data: dict, template: list):
+    """
+    Write the itinerary of a template with the times of a route.
+
+    :param data: The 'data' object of a TDX routing response with the template's fingerprint.
+    :param template: The list returned by to_template.
+    :return: The itinerary text, or None if the route has no departure time.
+    """
+    _, departure = first_route(data)
+    if departure is None:
+        return None
+
+    parts = []
+    for index, part in enumerate(template):
+        if index % 2 == 0:
+            parts.append(part)
+        else:
+            parts.append(route_renderer.format_time((departure + timedelta(seconds=part)).isoformat()))
+    return "".join(parts)
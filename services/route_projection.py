@@ -0,0 +1,90 @@
+import json
+import logging
+import threading
+import services.route_renderer as route_renderer
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {"projections": 0, "input_bytes": 0, "projected_bytes": 0}
+
+
+def project_section(section: dict) -> dict:
+    """
+    Keep only the fields of a section that the itinerary needs.
+
+    :param section: A section from the TDX response.
+    :return: The projected section.
+    """
+    departure = section.get("departure", {})
+    arrival = section.get("arrival", {})
+    travel_summary = section.get("travelSummary", {})
+
+    projected = {
+        "type": section.get("type"),
+        "duration": travel_summary.get("duration"),
+        "departure": {"time": departure.get("time"), "place": route_renderer.place_name(departure)},
+        "arrival": {"time": arrival.get("time"), "place": route_renderer.place_name(arrival)},
+    }
+
+    if section.get("type") == "pedestrian":
+        projected["length"] = travel_summary.get("length")
+    else:
+        transport = section.get("transport", {})
+        projected["transport"] = {
+            key: transport[key] for key in ("mode", "name", "headsign") if transport.get(key)
+        }
+
+    if isinstance(section.get("price"), (int, float)):
+        projected["fare"] = section["price"]
+
+    return projected
+
+
+def project(data: dict) -> dict:
+    """
+    Cut the TDX routing data down to the fields used by the itinerary: times, durations, fares,
+    place names, and transport modes and names. Polylines, coordinates, and actions are dropped.
+
+    :param data: The 'data' object of the TDX routing response.
+    :return: The projected data.
+    """
+    routes = []
+    for route in data.get("routes", []):
+        routes.append({
+            "travel_time": route.get("travel_time"),
+            "start_time": route.get("start_time"),
+            "end_time": route.get("end_time"),
+            "transfers": route.get("transfers"),
+            "fare": route_renderer.get_fare(route),
+            "sections": [project_section(section) for section in route.get("sections", [])],
+        })
+    return {"routes": routes}
+
+
+def dumps(data: dict, input_bytes: int) -> str:
+    """
+    Serialize the projected TDX data for a prompt, recording the size reduction.
+
+    :param data: The 'data' object of the TDX routing response.
+    :param input_bytes: The size of the input in the response body that was already read, so the
+        input is never serialized again just to be measured.
+    :return: The projected data as a JSON string.
+    """
+    projected = json.dumps(project(data), ensure_ascii=False, separators=(",", ":"))
+    projected_bytes = len(projected.encode())
+
+    with _lock:
+        _counters["projections"] += 1
+        _counters["input_bytes"] += input_bytes
+        _counters["projected_bytes"] += projected_bytes
+
+    logger.info("Projected TDX data from %d to %d bytes", input_bytes, projected_bytes)
+    return projected
+
+
+def stats() -> dict:
+    """Return the total input and projected sizes"""
+    with _lock:
+        ratio = _counters["projected_bytes"] / _counters["input_bytes"] if _counters["input_bytes"] else 0.0
+        return {**_counters, "ratio": ratio}
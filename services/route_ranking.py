@@ -0,0 +1,47 @@
+import math
+import services.route_renderer as route_renderer
+from services.pipeline import Route
+
+# The ranking that matches each preference of an intent
+PREFERENCE_ORDERS = {"省錢": "fare", "省時間": "time", "無": "time"}
+
+# The preference an intent takes after a ranking follow-up, transfers keep the current one
+ORDER_PREFERENCES = {"fare": "省錢", "time": "省時間"}
+
+
+def travel_time(route: dict) -> float:
+    """Return the travel time of a route in seconds, or infinity if TDX did not report it"""
+    value = route.get("travel_time")
+    return value if isinstance(value, (int, float)) else math.inf
+
+
+def fare(route: dict) -> float:
+    """Return the fare of a route, or infinity if it has none"""
+    value = route_renderer.get_fare(route)
+    return value if value is not None else math.inf
+
+
+def transfers(route: dict) -> float:
+    """Return the number of transfers of a route, or infinity if TDX did not report it"""
+    value = route.get("transfers")
+    return value if isinstance(value, (int, float)) else math.inf
+
+
+# Sort keys of each ranking, ties are broken by travel time and then by fare
+RANKING_KEYS = {
+    "fare": lambda route: (fare(route), travel_time(route)),
+    "time": lambda route: (travel_time(route), fare(route)),
+    "transfers": lambda route: (transfers(route), travel_time(route), fare(route)),
+}
+
+
+def rank(route: Route, order: str) -> Route:
+    """
+    Reorder the candidate routes of a TDX response, so the renderers describe the best one.
+
+    :param route: The route returned by TDX, holding one or more candidates.
+    :param order: 'fare', 'time', or 'transfers'.
+    :return: A new Route whose candidates are sorted; the given one is left unchanged.
+    """
+    routes = sorted(route.data.get("routes", []), key=RANKING_KEYS[order])
+    return Route({**route.data, "routes": routes}, route.size)
@@ -0,0 +1,145 @@
+from datetime import datetime
+
+# Traditional Chinese names of the TDX transport modes, matched case-insensitively
+TRANSPORT_MODE_NAMES = {
+    "mrt": "捷運",
+    "metro": "捷運",
+    "subway": "捷運",
+    "lrt": "輕軌",
+    "lightrail": "輕軌",
+    "bus": "公車",
+    "citybus": "公車",
+    "intercitybus": "客運",
+    "highwaybus": "客運",
+    "coach": "客運",
+    "train": "台鐵",
+    "rail": "台鐵",
+    "regionaltrain": "台鐵",
+    "trainregional": "台鐵",
+    "intercitytrain": "台鐵",
+    "tra": "台鐵",
+    "highspeedtrain": "高鐵",
+    "thsr": "高鐵",
+    "ferry": "渡輪",
+    "ship": "渡輪",
+}
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Convert a duration in seconds into minutes, hours, or days.
+
+    :param seconds: The duration in seconds.
+    :return: The duration in Traditional Chinese, e.g. '1 小時 5 分鐘'.
+    """
+    minutes = max(1, round(seconds / 60))
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+
+    parts = []
+    if days:
+        parts.append(f"{days} 天")
+    if hours:
+        parts.append(f"{hours} 小時")
+    if minutes:
+        parts.append(f"{minutes} 分鐘")
+    return " ".join(parts)
+
+
+def format_time(value: str) -> str:
+    """
+    Format a TDX timestamp as "month/day hour:minute".
+
+    :param value: The timestamp, e.g. '2024-06-17T06:55:45'.
+    :return: The formatted time, e.g. '06/17 06:55'.
+    """
+    return datetime.fromisoformat(value).strftime("%m/%d %H:%M")
+
+
+def format_mode(transport: dict) -> str:
+    """Return the Traditional Chinese name of a section's transport mode"""
+    mode = str(transport.get("mode", ""))
+    return TRANSPORT_MODE_NAMES.get(mode.replace("_", "").lower(), mode)
+
+
+def get_fare(route: dict):
+    """
+    Find the total fare of a route, which TDX reports under different keys.
+
+    :param route: A route from the TDX response.
+    :return: The fare as a number, or None if the route has no fare.
+    """
+    for key in ("total_price", "price", "fare"):
+        value = route.get(key)
+        if isinstance(value, dict):
+            value = value.get("total", value.get("price"))
+        if isinstance(value, (int, float)):
+            return value
+
+    # Fall back to the sum of the section fares
+    prices = [section.get("price") for section in route.get("sections", [])]
+    prices = [price for price in prices if isinstance(price, (int, float))]
+    return sum(prices) if prices else None
+
+
+def place_name(endpoint: dict) -> str:
+    """Return the name of a section's departure or arrival place"""
+    return endpoint.get("place", {}).get("name", "")
+
+
+def render_section(index: int, section: dict) -> str:
+    """
+    Render one traveling section as a numbered paragraph.
+
+    :param index: The section number.
+    :param section: A section from the TDX response.
+    :return: The paragraph text.
+    """
+    departure = section.get("departure", {})
+    arrival = section.get("arrival", {})
+    duration = format_duration(section.get("travelSummary", {}).get("duration", 0))
+
+    if section.get("type") == "pedestrian":
+        length = section.get("travelSummary", {}).get("length")
+        distance = f"（約 {round(length)} 公尺）" if length else ""
+        destination = place_name(arrival) or "目的地"
+        return (
+            f"{index}. 步行約 {duration}{distance}，{format_time(departure['time'])} 出發，"
+            f"{format_time(arrival['time'])} 抵達{destination}。"
+        )
+
+    transport = section.get("transport", {})
+    line = f"{format_mode(transport)}{transport.get('name', '')}"
+    headsign = f"（往{transport['headsign']}）" if transport.get("headsign") else ""
+    return (
+        f"{index}. {format_time(departure['time'])} 在{place_name(departure)}搭乘{line}{headsign}，"
+        f"約 {duration}後，於 {format_time(arrival['time'])} 在{place_name(arrival)}下車。"
+    )
+
+
+def render(data: dict) -> str:
+    """
+    Render the first TDX route as a Traditional Chinese itinerary.
+
+    :param data: The 'data' object of the TDX routing response.
+    :return: The itinerary text.
+    """
+    route = data["routes"][0]
+
+    fare = get_fare(route)
+    lines = [
+        "你好！幫你找到一條大眾運輸路線，一起出發吧！",
+        "",
+        f"票價：{fare:g} 元" if fare is not None else "票價：請以現場票價為準",
+        f"總交通時間：約 {format_duration(route['travel_time'])}",
+        f"出發時間：{format_time(route['start_time'])}",
+        f"抵達時間：{format_time(route['end_time'])}",
+        "",
+        "交通資訊：",
+    ]
+
+    for index, section in enumerate(route.get("sections", []), start=1):
+        lines.append(render_section(index, section))
+
+    lines.extend(["", "祝你旅途愉快！"])
+    return "\n".join(lines)
@@ -0,0 +1,254 @@
+import re
+import threading
+import unicodedata
+
+# Words that express the user's preference, checked in order
+PREFERENCE_KEYWORDS = {
+    "省錢": ["最便宜", "最省錢", "省錢", "便宜", "划算", "最低票價"],
+    "省時間": ["最快", "省時間", "省時", "最短時間", "最少時間", "快一點", "趕時間"],
+}
+
+# Words asking to rank the candidates of the last route differently, checked in order
+RANKING_KEYWORDS = {
+    "transfers": ["最少轉乘", "轉乘最少", "少轉乘", "不要轉乘", "不用轉乘", "不轉車", "少換車", "換車最少"],
+    "fare": ["最便宜", "最省錢", "省錢", "便宜", "票價最低", "最低票價"],
+    "time": ["最快", "省時間", "省時", "最短時間", "最少時間", "快一點"],
+}
+
+# Words asking for the way back from the last destination
+RETURN_KEYWORDS = ["回程", "返程", "回去", "回來", "反過來", "反方向", "怎麼回"]
+
+# Follow-ups are short; longer messages are parsed as new questions
+FOLLOW_UP_MAX_LENGTH = 12
+
+# Words a follow-up may hold besides its keywords; anything else, such as a place name, makes it a new question
+FOLLOW_UP_FILLER_PATTERN = re.compile(
+    r"(?:那麼|那|的|呢|嗎|吧|啊|呀|喔|我要|我想|想要|想|要|改成|改|換成|換|給我|幫我|請|看看|看|一下|一點|"
+    r"有沒有|可以|怎麼走|怎麼|如何|路線|走|去|來|[?!.,~])"
+)
+
+# Connectors between the origin and the destination; 到 in 到底 ("after all") is not one
+CONNECTOR_PATTERN = r"(?:到(?!底)|去|前往|->|→)"
+
+# Fillers around the place names, which are removed before the names are checked
+PREFIX_PATTERN = re.compile(r"^(?:請問|我想要|我想|我要|想要|想|要|請|幫我查|幫我|怎麼)+")
+SUFFIX_PATTERN = re.compile(
+    r"(?:要|該)?(?:怎麼走|怎麼去|怎麼搭|如何去|如何走|搭什麼|坐什麼|的路線|的方式|的交通方式|路線|交通)+$"
+)
+
+# Words that suggest the sentence is a question the rules did not understand
+QUESTION_PATTERN = re.compile(r"(?:什麼|甚麼|怎麼|如何|哪|嗎|呢|幾|多久|多少)")
+
+# Times, subjects, and plans that a name parsed without 從/由 may have picked up from the sentence
+LEADING_WORD_PATTERN = re.compile(
+    r"^(?:我|你|他|她|我們|大家|今天|明天|後天|今晚|明晚|早上|上午|中午|下午|晚上|傍晚|凌晨|"
+    r"週|星期|禮拜|[0-9一二兩三四五六七八九十]+點)"
+)
+ACTIVITY_PATTERN = re.compile(r"(?:玩|旅遊|旅行|出差|過夜|[0-9一二兩三四五六七八九十幾]+(?:天|晚|夜))")
+
+# Actions, times, conjunctions, and modifiers that a name may have picked up from the rest of the sentence.
+# 和/跟/與/或 only count between two words, so names such as 中和 and 和平東路 are kept.
+EXTRA_WORD_PATTERN = re.compile(
+    r"(?:出發|坐|搭|走|經過|途經|順路|還是|附近|旁邊|周邊|趕|比較|"
+    r"今天|明天|後天|今晚|明晚|早上|上午|中午|下午|晚上|傍晚|凌晨|[0-9一二兩三四五六七八九十]+點|"
+    r"(?<=..)(?:和|跟|與|或)(?=..))"
+)
+
+# Confidence of a clause without 從/由, which stays below the default threshold even with a preference
+UNMARKED_CONFIDENCE = 0.6
+
+CLAUSE_SEPARATOR = re.compile(r"[,.;:!?、。\s~]+")
+
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0}
+
+
+def detect_preference(text: str) -> str:
+    """
+    Detect the travel preference expressed in a message.
+
+    :param text: The normalized message.
+    :return: '省錢', '省時間', or '無'.
+    """
+    for preference, keywords in PREFERENCE_KEYWORDS.items():
+        if any(keyword in text for keyword in keywords):
+            return preference
+    return "無"
+
+
+def clean_name(name: str) -> str:
+    """
+    Remove fillers and preference words from a place name.
+
+    :param name: The raw place name.
+    :return: The cleaned place name.
+    """
+    for keywords in PREFERENCE_KEYWORDS.values():
+        for keyword in keywords:
+            name = name.replace(keyword, "")
+    name = PREFIX_PATTERN.sub("", name)
+    name = SUFFIX_PATTERN.sub("", name)
+    return name.strip("的 ")
+
+
+def is_valid_name(name: str) -> bool:
+    """Check if a cleaned place name looks like a place rather than part of a sentence"""
+    return (
+        2 <= len(name) <= 20
+        and not QUESTION_PATTERN.search(name)
+        and not re.search(CONNECTOR_PATTERN, name)
+        and not ACTIVITY_PATTERN.search(name)
+        and not EXTRA_WORD_PATTERN.search(name)
+    )
+
+
+def parse(text: str) -> tuple:
+    """
+    Extract the origin, destination, and preference from a message with simple patterns.
+
+    :param text: The user's message.
+    :return: A tuple of (extracted dictionary or None, confidence between 0 and 1).
+    """
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(rf"\s*((?:從|由)|{CONNECTOR_PATTERN})\s*", r"\1", text)
+    preference = detect_preference(text)
+
+    # Look for the single clause that mentions both places
+    clauses = [clause for clause in CLAUSE_SEPARATOR.split(text) if re.search(CONNECTOR_PATTERN, clause)]
+    if len(clauses) != 1:
+        return None, 0.0
+
+    clause = PREFIX_PATTERN.sub("", clauses[0])
+
+    match = re.search(rf"(?:從|由)(.+?){CONNECTOR_PATTERN}(.+)", clause)
+    marked = bool(match) and not clause[:match.start()]
+    if not marked:
+        match = re.fullmatch(rf"(.+?){CONNECTOR_PATTERN}(.+)", clause)
+        if not match:
+            return None, 0.0
+
+    origin = clean_name(match.group(1))
+    destination = clean_name(match.group(2))
+
+    if not is_valid_name(origin) or not is_valid_name(destination) or origin == destination:
+        return None, 0.0
+
+    # Without 從/由, the origin is only the text before the connector, which may hold the rest of the sentence
+    if not marked and (re.search("從|由", origin) or LEADING_WORD_PATTERN.match(origin)):
+        return None, 0.0
+
+    if not marked:
+        confidence = UNMARKED_CONFIDENCE
+    else:
+        confidence = 0.8 + (0.2 if preference != "無" else 0.0)
+
+    return {"origin": origin, "destination": destination, "preference": preference}, confidence
+
+
+def is_bare_follow_up(text: str) -> bool:
+    """
+    Check if nothing but follow-up keywords and fillers remains in a message, so it names no new place.
+
+    :param text: The normalized message without whitespace.
+    :return: True if the message holds at least one keyword and no other words.
+    """
+    keywords = RETURN_KEYWORDS + [keyword for words in RANKING_KEYWORDS.values() for keyword in words]
+    pattern = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+
+    remainder, count = re.subn(pattern, "", text)
+    return count > 0 and not FOLLOW_UP_FILLER_PATTERN.sub("", remainder)
+
+
+def parse_ranking(text: str):
+    """
+    Detect a follow-up asking for another ranking of the last route, such as "那最快的呢?".
+
+    :param text: The user's message.
+    :return: 'fare', 'time', or 'transfers', or None if the message is not such a follow-up.
+    """
+    text = "".join(unicodedata.normalize("NFKC", text).split())
+    if len(text) > FOLLOW_UP_MAX_LENGTH or not is_bare_follow_up(text):
+        return None
+
+    for order, keywords in RANKING_KEYWORDS.items():
+        if any(keyword in text for keyword in keywords):
+            return order
+    return None
+
+
+def parse_follow_up(text: str):
+    """
+    Detect a follow-up about the user's last question.
+
+    :param text: The user's message.
+    :return: 'return' for the way back, 'fare', 'time', or 'transfers' for another ranking,
+             or None if the message is not a follow-up.
+    """
+    normalized = "".join(unicodedata.normalize("NFKC", text).split())
+    if len(normalized) > FOLLOW_UP_MAX_LENGTH or not is_bare_follow_up(normalized):
+        return None
+
+    if any(keyword in normalized for keyword in RETURN_KEYWORDS):
+        return "return"
+    return parse_ranking(normalized)
+
+
+def record(hit: bool):
+    """Count a message answered by the rules (hit) or passed on to the LLM (miss)"""
+    with _lock:
+        _counters["hits" if hit else "misses"] += 1
+
+
+def stats() -> dict:
+    """Return the fast path counters and hit rate"""
+    with _lock:
+        total = _counters["hits"] + _counters["misses"]
+        return {**_counters, "hit_rate": _counters["hits"] / total if total else 0.0}
+
+
+if __name__ == '__main__':
+    # Messages the rules must parse, and messages they must leave to OpenAI
+    for message, expected in [
+        ("從台北車站到市政府，最快", {"origin": "台北車站", "destination": "市政府", "preference": "省時間"}),
+        ("我想從板橋去淡水", {"origin": "板橋", "destination": "淡水", "preference": "無"}),
+        ("從中和到和平東路最快", {"origin": "中和", "destination": "和平東路", "preference": "省時間"}),
+    ]:
+        assert parse(message) == (expected, 1.0 if expected["preference"] != "無" else 0.8), message
+
+    for message in [
+        "我明天要去台中，從台北出發，最便宜",
+        "下午三點從台北車站到101最快",
+        "明天從台北到高雄最便宜",
+        "從台北去花蓮玩三天",
+        "今天天氣到底好不好，最便宜",
+        "從台北車站到台北101搭捷運最快",
+        "從台北車站出發到台北101最快",
+        "從台北車站坐捷運到台北101最快",
+        "從台北車站經過西門到台北101最快",
+        "從台北車站到台北101明天早上最快",
+        "從台北車站到松山機場趕飛機最快",
+        "從台北車站到台北101和西門町最便宜",
+        "從台北車站還是搭公車到台北101最快",
+        "從台北車站到台北101附近的餐廳最快",
+        "從台北車站到101大樓比較快",
+    ]:
+        assert parse(message)[1] < 0.8, message
+
+    assert parse("台北車站到市政府最便宜")[1] == UNMARKED_CONFIDENCE
+
+    # Follow-ups about the last route, and short messages that name a new place
+    for message, expected in [
+        ("那回程呢?", "return"),
+        ("怎麼回去", "return"),
+        ("反過來", "return"),
+        ("那最快的呢?", "time"),
+        ("改成最便宜", "fare"),
+        ("有沒有少轉乘的", "transfers"),
+        ("我想回去台北車站", None),
+        ("怎麼回板橋", None),
+        ("我明天回來台北", None),
+        ("台中最便宜", None),
+        ("板橋最快", None),
+    ]:
+        assert parse_follow_up(message) == expected, message
+    print("rule_parser checks passed")
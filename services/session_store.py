@@ -0,0 +1,63 @@
+from dotenv import load_dotenv
+import os
+from services.cache import TTLCache
+from services.pipeline import Intent, Locations, Route
+
+# Load the .env file
+parent_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)  # Get the path of the parent directory
+env_path = os.path.join(parent_dir, ".env")
+
+load_dotenv(dotenv_path=env_path)
+
+# Sessions of at most SESSION_STORE_SIZE users are kept, each until it is idle for SESSION_IDLE_TTL seconds
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(30 * 60)))
+
+
+class Session:
+    """The last answered question of a user: its intent, resolved locations, and route candidates"""
+
+    __slots__ = ("intent", "locations", "route")
+
+    def __init__(self, intent: Intent, locations: Locations, route: Route):
+        self.intent = intent
+        self.locations = locations
+        self.route = route
+
+
+class SessionStore:
+    """
+    A bounded store of sessions keyed on LINE user ID.
+
+    Sessions are replaced rather than modified, so the same Session can be shared by users
+    whose questions were coalesced.
+    """
+
+    def __init__(self, max_size: int = SESSION_STORE_SIZE, idle_ttl: float = SESSION_IDLE_TTL):
+        self._cache = TTLCache(max_size=max_size, ttl=idle_ttl)
+
+    def get(self, user_id: str):
+        """
+        Return the session of a user and restart its idle timer.
+
+        :param user_id: The LINE user ID.
+        :return: The Session, or None if the user has none or it expired.
+        """
+        session = self._cache.get(user_id)
+        if session is not None:
+            self._cache.set(user_id, session)
+        return session
+
+    def set(self, user_id: str, session: Session):
+        """Store the session of a user"""
+        self._cache.set(user_id, session)
+
+    def delete(self, user_id: str):
+        """Remove the session of a user"""
+        self._cache.delete(user_id)
+
+    def stats(self) -> dict:
+        """Return the number of sessions and the lookup counters"""
+        return self._cache.stats()
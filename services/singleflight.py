@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+
+class _Call:
+    """One in-flight call of the thread-based path, waited on by the callers that joined it"""
+
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one computation.
+
+    The first caller of a key (the leader) runs the function, and callers arriving while it is
+    still running (the followers) wait for it and receive the same result or exception. Nothing
+    is kept once the call finishes, so this is not a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self._counters = {"leaders": 0, "followers": 0}
+
+    def do(self, key, func, *args):
+        """
+        Run func(*args), or wait for the call already running with the same key.
+
+        :param key: A hashable key identifying identical calls.
+        :param func: The function to run.
+        :return: The result of the shared call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._counters["leaders" if leader else "followers"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    async def do_async(self, key, func, *args):
+        """
+        The asyncio version of do, for coroutine functions running on one event loop.
+
+        The shared call runs as its own task, so a caller being cancelled does not cancel it
+        for the others.
+
+        :param key: A hashable key identifying identical calls.
+        :param func: The coroutine function to run.
+        :return: The result of the shared call.
+        """
+        task = self._tasks.get(key)
+        leader = task is None
+        if leader:
+            task = self._tasks[key] = asyncio.ensure_future(func(*args))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+        with self._lock:
+            self._counters["leaders" if leader else "followers"] += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        """Return the leader and follower counts, and the share of calls that were coalesced"""
+        with self._lock:
+            total = self._counters["leaders"] + self._counters["followers"]
+            return {
+                **self._counters,
+                "in_flight": len(self._calls) + len(self._tasks),
+                "ratio": self._counters["followers"] / total if total else 0.0,
+            }
@@ -1,5 +1,17 @@
+import httpx
 import requests
+import services.http_client as http_client
+import services.rate_limiter as rate_limiter
+import services.circuit_breaker as circuit_breaker
+import services.hedging as hedging
+from services.circuit_breaker import CircuitOpenError
+from services.cache import TTLCache
+from services.pipeline import StageResult, Locations, Route
+import asyncio
 import json
+import logging
+import threading
+import time
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 from dotenv import load_dotenv
@@ -16,64 +28,195 @@ load_dotenv(dotenv_path=env_path)
 TDX_CLIENT_ID = os.getenv("TDX_CLIENT_ID")
 TDX_CLIENT_SECRET = os.getenv("TDX_CLIENT_SECRET")
 
+# Route cache: coordinates are snapped to a grid of ROUTE_CACHE_GRID degrees (about 100 m by default),
+# departure times to buckets of ROUTE_CACHE_BUCKET seconds, and an entry expires with its bucket
+ROUTE_CACHE_GRID = float(os.getenv("ROUTE_CACHE_GRID", "0.001"))
+ROUTE_CACHE_BUCKET = int(os.getenv("ROUTE_CACHE_BUCKET", "600"))
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", "256"))
+ROUTE_CACHE_MAX_BYTES = int(os.getenv("ROUTE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Number of candidate routes requested at once, so a follow-up asking for another ranking
+# is answered locally
+ROUTE_CANDIDATES = int(os.getenv("ROUTE_CANDIDATES", "3"))
+
+# The access token is refreshed this many seconds before it expires
+TDX_TOKEN_REFRESH_MARGIN = float(os.getenv("TDX_TOKEN_REFRESH_MARGIN", "300"))
+
+logger = logging.getLogger(__name__)
+
 
 # Simulating a config.py configuration file
 config = {"API_KEY": {"tdx": {"ID": TDX_CLIENT_ID, "Secret": TDX_CLIENT_SECRET}}}
 
-auth_url = (
-    "https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token"
+# Endpoints of the TDX API, which can point to a local stand-in for benchmarks
+auth_url = os.getenv(
+    "TDX_AUTH_URL", "https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token"
 )
+routing_url = os.getenv("TDX_ROUTING_URL", "https://tdx.transportdata.tw/api/maas/routing")
+basic_url = os.getenv("TDX_BASIC_URL", "https://tdx.transportdata.tw/api/basic")
+
+# Errors of a token or routing request that are reported as a routing failure: transport errors and
+# timeouts, and bodies that are not the expected JSON. CircuitOpenError is a failure too.
+REQUEST_ERRORS = (requests.RequestException, httpx.HTTPError, ValueError, KeyError, CircuitOpenError)
+
+
+class AccessTokenManager:
+    """
+    Thread-safe holder of an access token that is refreshed by a single caller at a time.
+
+    Once the token is within refresh_margin seconds of its expiry, one caller refreshes it while the
+    others keep using the current token. Once it has expired, callers wait for the refresh in
+    progress and share its result instead of requesting tokens of their own.
+    """
+
+    def __init__(self, fetch_token, refresh_margin: float = TDX_TOKEN_REFRESH_MARGIN):
+        """
+        :param fetch_token: A callable returning a (access_token, expires_in) tuple.
+        :param refresh_margin: Seconds before expiry at which the token is refreshed.
+        """
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()
+        self._access_token = ""
+        self._expire_time = 0.0
+        self.refresh_count = 0
+
+    def _is_valid(self, margin: float = 0.0) -> bool:
+        return bool(self._access_token) and time.monotonic() < self._expire_time - margin
+
+    def _refresh(self):
+        # Must be called with the lock held
+        access_token, expires_in = self.fetch_token()
+        self._access_token = access_token
+        self._expire_time = time.monotonic() + expires_in
+        self.refresh_count += 1
+
+    def get_token(self) -> str:
+        """Retrieve a valid access token, refreshing it when needed"""
+        if self._is_valid(self.refresh_margin):
+            return self._access_token
+
+        if self._is_valid():
+            # The token still works: refresh it early unless another caller already is
+            if self._lock.acquire(blocking=False):
+                try:
+                    if not self._is_valid(self.refresh_margin):
+                        self._refresh()
+                except Exception:
+                    logger.exception("Failed to refresh the access token early")
+                finally:
+                    self._lock.release()
+            return self._access_token
+
+        with self._lock:
+            if not self._is_valid():
+                self._refresh()
+            return self._access_token
+
+    def invalidate(self):
+        """Discard the current token, so the next caller fetches a new one"""
+        with self._lock:
+            self._access_token = ""
+
+
+class AsyncAccessTokenManager(AccessTokenManager):
+    """
+    The asyncio version of AccessTokenManager, for callers running on one event loop.
+
+    fetch_token is a coroutine function returning a (access_token, expires_in) tuple.
+    """
+
+    def __init__(self, fetch_token, refresh_margin: float = TDX_TOKEN_REFRESH_MARGIN):
+        super().__init__(fetch_token, refresh_margin)
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self):
+        # Must be called with the lock held
+        access_token, expires_in = await self.fetch_token()
+        self._access_token = access_token
+        self._expire_time = time.monotonic() + expires_in
+        self.refresh_count += 1
+
+    async def get_token(self) -> str:
+        """Retrieve a valid access token, refreshing it when needed"""
+        if self._is_valid(self.refresh_margin):
+            return self._access_token
+
+        if self._is_valid():
+            # The token still works: refresh it early unless another task already is
+            if not self._lock.locked():
+                async with self._lock:
+                    try:
+                        if not self._is_valid(self.refresh_margin):
+                            await self._refresh()
+                    except Exception:
+                        logger.exception("Failed to refresh the access token early")
+            return self._access_token
+
+        async with self._lock:
+            if not self._is_valid():
+                await self._refresh()
+            return self._access_token
+
+    def invalidate(self):
+        """Discard the current token, so the next caller fetches a new one"""
+        self._access_token = ""
 
 
 class TdxUnit:
     def __init__(self):
-        self.access_token_info = {"access_token": "", "expire_time": datetime.now()}
-        self.user_input = {
-            "origin": [],
-            "destination": [],
-            "gc": 0,
-            "transit": [3, 4, 5, 6, 7, 8, 9],
-            "depart": datetime.now(),
-            "arrival": datetime.now(),
-        }
+        self.token_manager = AccessTokenManager(self.request_access_token)
+        self.async_token_manager = AsyncAccessTokenManager(self.request_access_token_async)
+        self.route_cache = TTLCache(max_size=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_BUCKET, max_bytes=ROUTE_CACHE_MAX_BYTES)
 
     @staticmethod
     def format_time(time: datetime) -> str:
         """Format datetime into the format required by the TDX API without over-encoding"""
         return time.strftime("%Y-%m-%dT%H:%M:%S")
 
-    def update_user_input(self, input_data: dict):
-        """Update user input"""
-        self.user_input.update(
-            {
-                "origin": input_data["origin"],
-                "destination": input_data["destination"],
-                "gc": input_data["gc"],
-                "transit": input_data["transit"],
-                "depart": input_data["depart"],
-                "arrival": input_data["arrival"],
-            }
-        )
-
-    def get_url(self) -> str:
-        """Generate the complete API URL"""
-        transit_str = ",".join(map(str, self.user_input["transit"]))
+    def get_url(self, user_input: dict) -> str:
+        """Generate the complete API URL for the routing parameters of one request"""
+        transit_str = ",".join(map(str, user_input["transit"]))
         params = {
-            "origin": f"{self.user_input['origin'][1]},{self.user_input['origin'][0]}",
-            "destination": f"{self.user_input['destination'][1]},{self.user_input['destination'][0]}",
-            "gc": self.user_input["gc"],
-            "top": 1,
+            "origin": f"{user_input['origin'][1]},{user_input['origin'][0]}",
+            "destination": f"{user_input['destination'][1]},{user_input['destination'][0]}",
+            "gc": user_input["gc"],
+            "top": ROUTE_CANDIDATES,
             "transit": transit_str,
             "transfer_time": "0,30",
-            "depart": self.format_time(self.user_input["depart"]),
-            "arrival": self.format_time(self.user_input["arrival"]),
+            "depart": self.format_time(user_input["depart"]),
+            "arrival": self.format_time(user_input["arrival"]),
             "first_mile_mode": 0,
             "first_mile_time": 30,
             "last_mile_mode": 0,
             "last_mile_time": 30,
         }
-        base_url = "https://tdx.transportdata.tw/api/maas/routing"
-        return f"{base_url}?{urlencode(params)}"
+        return f"{routing_url}?{urlencode(params)}"
+
+    @staticmethod
+    def get_cache_key(input_data: dict) -> tuple:
+        """
+        Build the route cache key from the snapped coordinates, the preference and the departure time bucket.
+
+        :param input_data: The routing parameters.
+        :return: A hashable cache key.
+        """
+        def snap(point: list) -> tuple:
+            return tuple(round(value / ROUTE_CACHE_GRID) for value in point)
+
+        return (
+            snap(input_data["origin"]),
+            snap(input_data["destination"]),
+            input_data["gc"],
+            int(input_data["depart"].timestamp() // ROUTE_CACHE_BUCKET),
+        )
+
+    @staticmethod
+    def get_cache_ttl(input_data: dict) -> float:
+        """Return the number of seconds until the departure time bucket ends"""
+        depart = input_data["depart"].timestamp()
+        return ROUTE_CACHE_BUCKET - depart % ROUTE_CACHE_BUCKET
 
     def get_auth_header(self) -> dict:
         """Get authentication header"""
@@ -87,64 +230,153 @@ class TdxUnit:
             "client_secret": config["API_KEY"]["tdx"]["Secret"],
         }
 
-    def update_access_token(self):
-        """Update the access token"""
-        response = requests.post(
-            auth_url, headers=self.get_auth_header(), data=self.get_auth_body()
+    def request_access_token(self) -> tuple:
+        """Request a new access token through the TDX circuit breaker, returning it with its lifetime in seconds"""
+        response = circuit_breaker.breakers["tdx"].call(
+            http_client.post, auth_url, headers=self.get_auth_header(), data=self.get_auth_body()
         )
         response_data = response.json()
-        self.access_token_info["access_token"] = response_data["access_token"]
-        self.access_token_info["expire_time"] = datetime.now() + timedelta(
-            seconds=response_data["expires_in"]
+        return response_data["access_token"], response_data["expires_in"]
+
+    async def request_access_token_async(self) -> tuple:
+        """The asyncio version of request_access_token"""
+        response = await circuit_breaker.breakers["tdx"].call_async(
+            http_client.post_async, auth_url, headers=self.get_auth_header(), data=self.get_auth_body()
         )
+        response_data = response.json()
+        return response_data["access_token"], response_data["expires_in"]
 
     def get_access_token(self) -> str:
         """Retrieve a valid access token"""
-        if (
-            not self.access_token_info["access_token"]
-            or datetime.now() >= self.access_token_info["expire_time"]
-        ):
-            self.update_access_token()
-        return self.access_token_info["access_token"]
+        return self.token_manager.get_token()
 
     def get_data_header(self, access_token: str) -> dict:
         """Get header for data request"""
         return {"Authorization": f"Bearer {access_token}", "Accept-Encoding": "gzip"}
 
-    def get_result(self, input_string: str) -> str:
-        """Process input and send a request to the API"""
-        input_data = json.loads(input_string)
+    @staticmethod
+    def get_route_input(locations: Locations) -> dict:
+        """Build the routing parameters for one pair of locations, departing in five minutes"""
+        return {
+            **locations.to_dict(),
+            "transit": [3, 4, 5, 6, 7, 8, 9],
+            "depart": datetime.now() + timedelta(minutes=5),
+            "arrival": datetime.now() + timedelta(days=1),
+        }
 
-        if not input_data.get("result", False):
-            return json.dumps(input_data)
+    def request_route(self, user_input: dict, access_token: str):
+        """Send a routing request through the TDX circuit breaker, hedging it when it is slow"""
+        return circuit_breaker.breakers["tdx"].call(
+            hedging.get, "tdx", self.get_url(user_input), config["API_KEY"]["tdx"]["ID"],
+            headers=self.get_data_header(access_token),
+        )
 
-        input_data["data"].update(
-            {
-                "transit": [3, 4, 5, 6, 7, 8, 9],
-                "depart": datetime.now() + timedelta(minutes=5),
-                "arrival": datetime.now() + timedelta(days=1),
-            }
+    async def request_route_async(self, user_input: dict, access_token: str):
+        """The asyncio version of request_route"""
+        return await circuit_breaker.breakers["tdx"].call_async(
+            hedging.get_async, "tdx", self.get_url(user_input), config["API_KEY"]["tdx"]["ID"],
+            headers=self.get_data_header(access_token),
         )
 
-        self.update_user_input(input_data["data"])
+    def parse_route_response(self, response, cache_key: tuple, user_input: dict) -> StageResult:
+        """
+        Parse a routing response and cache the route it holds.
+
+        :param response: The response of the requests session or of the asyncio client.
+        :param cache_key: The route cache key of the request.
+        :param user_input: The routing parameters of the request.
+        :return: A StageResult holding the Route, or a failure message.
+        """
+        if response.status_code == 429:
+            raise rate_limiter.throttled(
+                "tdx", config["API_KEY"]["tdx"]["ID"], rate_limiter.parse_retry_after(response.headers)
+            )
 
-        access_token = self.get_access_token()
-        response = requests.get(
-            self.get_url(), headers=self.get_data_header(access_token)
-        )
         response_data = response.json()
 
         if response_data.get("result") == "fail":
-            return json.dumps(
-                {
-                    "result": False,
-                    "message": response_data.get("error", "Unknown error"),
-                }
-            )
+            return StageResult.fail(response_data.get("error", "Unknown error"))
         elif not response_data.get("data", {}).get("routes", []):
-            return json.dumps({"result": False, "message": "Route not found"})
+            return StageResult.fail("Route not found")
+
+        route = Route(response_data["data"], len(response.content))
+        self.route_cache.set(cache_key, route, self.get_cache_ttl(user_input), route.size)
+
+        return StageResult.ok(route)
+
+    def get_route(self, locations: Locations) -> StageResult:
+        """
+        Send a routing request to the API for one pair of locations.
+
+        :param locations: The coordinates of the origin and destination, and the preference.
+        :return: A StageResult holding the Route, or a failure message.
+        """
+        user_input = self.get_route_input(locations)
+
+        cache_key = self.get_cache_key(user_input)
+        cached = self.route_cache.get(cache_key)
+        if cached is not None:
+            return StageResult.ok(cached)
+
+        rate_limiter.acquire("tdx", config["API_KEY"]["tdx"]["ID"])
+        try:
+            access_token = self.get_access_token()
+            response = self.request_route(user_input, access_token)
+
+            # The token was revoked before its expiry, fetch a new one and try once more
+            if response.status_code == 401:
+                self.token_manager.invalidate()
+                access_token = self.get_access_token()
+                response = self.request_route(user_input, access_token)
+
+            return self.parse_route_response(response, cache_key, user_input)
+
+        except REQUEST_ERRORS as e:
+            # Report TDX being unreachable, failing, or behind an open breaker as a routing failure
+            return StageResult.fail(str(e))
+
+    async def get_route_async(self, locations: Locations) -> StageResult:
+        """
+        The asyncio version of get_route, sharing its route cache.
+
+        :param locations: The coordinates of the origin and destination, and the preference.
+        :return: A StageResult holding the Route, or a failure message.
+        """
+        user_input = self.get_route_input(locations)
+
+        cache_key = self.get_cache_key(user_input)
+        cached = self.route_cache.get(cache_key)
+        if cached is not None:
+            return StageResult.ok(cached)
+
+        await rate_limiter.acquire_async("tdx", config["API_KEY"]["tdx"]["ID"])
+        try:
+            access_token = await self.async_token_manager.get_token()
+            response = await self.request_route_async(user_input, access_token)
+
+            # The token was revoked before its expiry, fetch a new one and try once more
+            if response.status_code == 401:
+                self.async_token_manager.invalidate()
+                access_token = await self.async_token_manager.get_token()
+                response = await self.request_route_async(user_input, access_token)
+
+            return self.parse_route_response(response, cache_key, user_input)
+
+        except REQUEST_ERRORS as e:
+            # Report TDX being unreachable, failing, or behind an open breaker as a routing failure
+            return StageResult.fail(str(e))
+
+    def get_result(self, input_string: str) -> str:
+        """Process input and send a request to the API"""
+        input_data = json.loads(input_string)
+
+        if not input_data.get("result", False):
+            return json.dumps(input_data)
 
-        return json.dumps({"result": True, "data": response_data["data"]})
+        result = self.get_route(Locations.from_dict(input_data["data"]))
+        if not result.result:
+            return result.to_json()
+        return result.to_json(result.data.data)
 
 
 # For debugging and testing
@@ -0,0 +1,240 @@
+import contextvars
+import inspect
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+import services.metrics as metrics
+from services.event_dedup import EventDeduplicator
+
+logger = logging.getLogger(__name__)
+
+
+def source_key(event):
+    """Return the user, group or room an event came from, or the event itself if it has no source"""
+    source = getattr(event, "source", None)
+    for name in ("user_id", "group_id", "room_id"):
+        value = getattr(source, name, None)
+        if value:
+            return value
+    return id(event)
+
+
+def group_events(events: list) -> list:
+    """
+    Split the events of a delivery by the user who sent them, keeping their order.
+
+    :param events: The parsed webhook events.
+    :return: A list of event lists, one per user, in order of each user's first event.
+    """
+    groups = {}
+    for event in events:
+        groups.setdefault(source_key(event), []).append(event)
+    return list(groups.values())
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """
+    A WebhookHandler that can acknowledge a delivery before its events are processed.
+
+    The events of a delivery are grouped by the user who sent them. Each user's events are handled
+    in order, while different users are handled concurrently: on a shared thread pool, at most
+    batch_concurrency users of a delivery at a time, or by the queue workers in async_mode.
+
+    Events already received, such as redeliveries, are dropped when a deduplicator is given.
+
+    When async_mode is enabled, handle() only validates the signature and puts the groups on a
+    bounded in-process queue, which is drained by a pool of worker threads. When the queue is
+    full, the group is dropped and counted instead of blocking the webhook request.
+    """
+
+    def __init__(self, channel_secret: str, async_mode: bool = False, workers: int = 4, max_queue_size: int = 100,
+                 batch_workers: int = 8, batch_concurrency: int = 4, deduplicator: EventDeduplicator = None):
+        super().__init__(channel_secret)
+        self.deduplicator = deduplicator
+        self.async_mode = async_mode
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_workers = batch_workers
+        self.batch_concurrency = batch_concurrency
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._executor = None
+        self._counters = {"batches": 0, "enqueued": 0, "dropped": 0, "processed": 0, "failed": 0}
+
+    def handle(self, body, signature):
+        """
+        Validate the webhook and dispatch its events, in the background when async_mode is enabled.
+
+        :param body: Webhook request body (as text).
+        :param signature: X-Line-Signature value (as text).
+        """
+        payload = self.parser.parse(body, signature, as_payload=True)
+        received = time.perf_counter()
+
+        if payload.events:
+            self._count("batches")
+            metrics.webhook_batch_size.observe(len(payload.events))
+
+        events = payload.events
+        if self.deduplicator is not None:
+            events = self.deduplicator.filter(events)
+        groups = group_events(events)
+
+        if not self.async_mode:
+            self.dispatch_groups(groups, payload.destination, received)
+            return
+
+        self._start_workers()
+
+        for group in groups:
+            try:
+                self.queue.put_nowait((group, payload.destination, received))
+                self._count("enqueued", len(group))
+            except queue.Full:
+                self._count("dropped", len(group))
+                logger.warning(
+                    "Webhook queue is full, dropping events %s",
+                    [getattr(event, "webhook_event_id", None) for event in group],
+                )
+
+    def dispatch_groups(self, groups: list, destination, received: float):
+        """
+        Dispatch the event groups of one delivery and wait for them, raising the first error.
+
+        :param groups: The events of the delivery, grouped by user.
+        :param destination: The bot user ID that received the events.
+        :param received: The time.perf_counter() value when the delivery arrived.
+        """
+        if len(groups) <= 1 or self.batch_concurrency <= 1:
+            for group in groups:
+                self.dispatch_group(group, destination, received)
+            return
+
+        executor = self._start_executor()
+        slots = threading.BoundedSemaphore(self.batch_concurrency)
+
+        futures = []
+        for group in groups:
+            # Wait for a free slot, so one large delivery cannot take the whole pool
+            slots.acquire()
+            future = executor.submit(contextvars.copy_context().run, self.dispatch_group, group, destination, received)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        wait(futures)
+
+        # Raise the first error in the delivery order, so the message is deterministic
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def dispatch_group(self, group: list, destination, received: float):
+        """
+        Dispatch the events of one user in order, recording when each of them completes.
+
+        :param group: The events of the user.
+        :param destination: The bot user ID that received the events.
+        :param received: The time.perf_counter() value when the delivery arrived.
+        """
+        for index, event in enumerate(group):
+            try:
+                self.dispatch(event, destination)
+            except Exception:
+                # Neither this event nor the user's later ones were handled, let a redelivery retry them
+                if self.deduplicator is not None:
+                    for pending in group[index:]:
+                        self.deduplicator.release(pending)
+                raise
+            finally:
+                metrics.webhook_event_duration.observe(time.perf_counter() - received)
+
+    def dispatch(self, event, destination=None):
+        """
+        Run the handler registered for an event, following the same lookup rules as WebhookHandler.handle.
+
+        :param event: A parsed webhook event.
+        :param destination: The bot user ID that received the event.
+        """
+        func = None
+
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+
+        if func is None:
+            func = self._default
+
+        if func is None:
+            logger.info("No handler of %s and no default handler", event.__class__.__name__)
+        else:
+            self.invoke(func, event, destination)
+
+    @staticmethod
+    def invoke(func, event, destination):
+        """Call a handler with the arguments it accepts, as WebhookHandler does"""
+        spec = inspect.getfullargspec(func)
+        if spec.varargs is not None or len(spec.args) == 2:
+            func(event, destination)
+        elif len(spec.args) == 1:
+            func(event)
+        else:
+            func()
+
+    def stats(self) -> dict:
+        """Return queue depth and event counters"""
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "async_mode": self.async_mode,
+            "workers": self.workers,
+            "batch_workers": self.batch_workers,
+            "batch_concurrency": self.batch_concurrency,
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            **counters,
+            "dedup": self.deduplicator.stats() if self.deduplicator is not None else {},
+        }
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _start_workers(self):
+        # Threads are started lazily so that they are created in the serving process, not before a fork
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"webhook-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _start_executor(self) -> ThreadPoolExecutor:
+        # Created lazily for the same reason as the worker threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.batch_workers, thread_name_prefix="webhook-batch")
+            return self._executor
+
+    def _worker(self):
+        while True:
+            group, destination, received = self.queue.get()
+            try:
+                for event in group:
+                    try:
+                        self.dispatch_group([event], destination, received)
+                        self._count("processed")
+                    except Exception:
+                        self._count("failed")
+                        logger.exception("Failed to process webhook event")
+            finally:
+                self.queue.task_done()